@@ -41,7 +41,7 @@ class ClassificationEvalItem(EvalItem):
             mismatched_spans = False
             region = EvalItem.has_regions([x, y])
             if region:
-                mismatched_spans = not bool(EvalItem.general_iou_by_type(region, x, y))
+                mismatched_spans = not bool(EvalItem.general_iou_by_type(region, x, y, self._polygons))
             # If order does not matter, sort labels
             if not label_order_matters:
                 labels = sorted(labels)
@@ -1,9 +1,25 @@
+import math
+
+import numpy as np
+
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
 from operator import itemgetter
 from functools import partial
-from dateutil import parser
 
 import evalme.utils
 
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# spans of item converted to arrays, kind is None if spans can't be compared as arrays
+Spans = namedtuple('Spans', ['kind', 'groups', 'starts', 'ends'])
+
+
+def _epoch_microseconds(dt):
+    epoch = EPOCH_UTC if dt.tzinfo is not None else EPOCH
+    return (dt - epoch) // timedelta(microseconds=1)
+
 
 class EvalItem(object):
     """
@@ -16,6 +32,9 @@ class EvalItem(object):
         self._raw_data = raw_data
         self._shape_key = shape_key or self.SHAPE_KEY
         self._kwargs = kwargs
+        self._polygons = evalme.utils.PolygonsCache()
+        self._labels_index_cache = None
+        self._spans = None
         if not self._shape_key:
             raise ValueError('Shape key is undefined')
 
@@ -36,6 +55,102 @@ class EvalItem(object):
     def __len__(self):
         return len(self._raw_data)
 
+    def _labels_key(self, value):
+        """
+        Hashable labels of value, values are compared by exact labels equality when keys are equal
+        """
+        return evalme.utils._hashable(value.get(self._shape_key))
+
+    def _labels_index(self):
+        """
+        Indices of values by their labels key, built once per item to find identically labeled values
+        :return: dict {labels key: [index]}
+        """
+        if self._labels_index_cache is None:
+            index = {}
+            for i, value in enumerate(self.get_values_iter()):
+                index.setdefault(self._labels_key(value), []).append(i)
+            self._labels_index_cache = index
+        return self._labels_index_cache
+
+    def _span_bounds(self, value):
+        """
+        Span bounds in the same form as they are compared by `general_iou_by_type`,
+        datetimes are converted to epoch microseconds
+        :return: (kind, group, start, end) or None if value is not span
+        """
+        region = EvalItem.has_regions([value])
+        if region == 'spans_with_offsets':
+            start, end = value['startOffset'], value['endOffset']
+            if not isinstance(start, (int, float)) or not isinstance(end, (int, float)):
+                return None
+            group = (evalme.utils._hashable(value['start']), evalme.utils._hashable(value['end']))
+            kind = 'offsets'
+        elif region == 'spans':
+            group = None
+            try:
+                start, end = float(value['start']), float(value['end'])
+                kind = 'number'
+            except ValueError:
+                # spans are compared as datetimes if any bound is not a number
+                try:
+                    start, end = evalme.utils.parse_datetime(value['start']), evalme.utils.parse_datetime(value['end'])
+                except (ValueError, TypeError, OverflowError):
+                    return None
+                if (start.tzinfo is None) != (end.tzinfo is None):
+                    return None
+                kind = 'datetime_tz' if start.tzinfo is not None else 'datetime'
+                start, end = _epoch_microseconds(start), _epoch_microseconds(end)
+            except TypeError:
+                return None
+        else:
+            return None
+        if not math.isfinite(start) or not math.isfinite(end):
+            return None
+        return kind, group, start, end
+
+    def _spans_arrays(self):
+        """
+        Spans of all values converted once to np.array starts and ends
+        :return: Spans, kind is None if values are not spans of the same kind
+        """
+        if self._spans is None:
+            bounds = [self._span_bounds(value) for value in self.get_values_iter()]
+            kinds = set(b[0] if b is not None else None for b in bounds)
+            if len(kinds) != 1 or None in kinds:
+                self._spans = Spans(None, None, None, None)
+            else:
+                kind = kinds.pop()
+                dtype = np.int64 if kind.startswith('datetime') else np.float64
+                self._spans = Spans(kind,
+                                    [b[1] for b in bounds],
+                                    np.array([b[2] for b in bounds], dtype=dtype),
+                                    np.array([b[3] for b in bounds], dtype=dtype))
+        return self._spans
+
+    def _spans_iou_matrix(self, item):
+        """
+        IOU between each span of self (rows) and each span of item (columns) computed by broadcasting
+        :param item: to be compared with self
+        :return: np.array(n, m) or None if spans can't be compared as arrays
+        """
+        spans, item_spans = self._spans_arrays(), item._spans_arrays()
+        if spans.kind is None or spans.kind != item_spans.kind:
+            return None
+        s1, e1 = spans.starts[:, None], spans.ends[:, None]
+        s2, e2 = item_spans.starts[None, :], item_spans.ends[None, :]
+        intersection = np.minimum(e1, e2) - np.maximum(s1, s2)
+        union = np.maximum(e1, e2) - np.minimum(s1, s2)
+        matched = ~((s2 > e1) | (s1 > e2)) & (union != 0)
+        if spans.kind == 'offsets':
+            # spans with offsets are matched inside the same start/end blocks
+            codes = {}
+            rows = [codes.setdefault(g, len(codes)) for g in spans.groups]
+            cols = [codes.setdefault(g, len(codes)) for g in item_spans.groups]
+            matched &= np.array(rows, dtype=np.int64)[:, None] == np.array(cols, dtype=np.int64)[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(matched, intersection / np.where(union != 0, union, 1), 0.)
+
     @staticmethod
     def has_spans(results_list):
         for r in results_list:
@@ -91,14 +206,17 @@ class EvalItem(object):
         return types[0] if all_same else None
 
     @staticmethod
-    def general_iou_by_type(t, gt, pred):
+    def general_iou_by_type(t, gt, pred, polygons=None):
         """
         Get iou score by type of shape
         :param t: Type of shape
         :param gt: Ground truth result
         :param pred: Predicted result
+        :param polygons: PolygonsCache to reuse built polygons
         :return: IoU score float[0..1]
         """
+        if t == 'polygon':
+            return EvalItem.polygon_iou(gt, pred, polygons)
         SHAPES_IOU = {
             'bbox': EvalItem.bbox_iou,
             'spans': EvalItem.spans_iou,
@@ -120,8 +238,8 @@ class EvalItem(object):
             s1, e1 = float(x['start']), float(x['end'])
             s2, e2 = float(y['start']), float(y['end'])
         except ValueError:
-            s1, e1 = parser.parse(x['start']), parser.parse(x['end'])
-            s2, e2 = parser.parse(y['start']), parser.parse(y['end'])
+            s1, e1 = evalme.utils.parse_datetime(x['start']), evalme.utils.parse_datetime(x['end'])
+            s2, e2 = evalme.utils.parse_datetime(y['start']), evalme.utils.parse_datetime(y['end'])
 
         if s2 > e1 or s1 > e2:
             return 0
@@ -189,10 +307,13 @@ class EvalItem(object):
         return iou
 
     @staticmethod
-    def polygon_iou(polyA, polyB):
+    def polygon_iou(polyA, polyB, polygons=None):
         if polyA.get('points') and polyB.get('points'):
-            pA = evalme.utils._try_build_poly(polyA['points'])
-            pB = evalme.utils._try_build_poly(polyB['points'])
+            build = polygons.get if polygons is not None else evalme.utils._try_build_poly
+            pA = build(polyA['points'])
+            pB = build(polyB['points'])
+            if not evalme.utils.bounds_overlap(pA.bounds, pB.bounds):
+                return 0
             inter_area = pA.intersection(pB).area
             iou = inter_area / (pA.area + pB.area - inter_area)
         else:
@@ -0,0 +1,37 @@
+"""
+Benchmark of brush RLE decoding: bit string based decoder vs `decode_rle`
+"""
+import time
+
+import numpy as np
+
+from evalme.image.brush import decode_rle, decode_rle_bit_string, encode_rle
+
+
+def random_mask(height, width, blobs=200, seed=0):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width, 4), dtype=np.uint8)
+    for _ in range(blobs):
+        y, x = rng.integers(0, height), rng.integers(0, width)
+        h, w = rng.integers(5, height // 10), rng.integers(5, width // 10)
+        mask[y:y + h, x:x + w] = 255
+    return mask
+
+
+def timeit(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    for height, width in [(480, 640), (1080, 1920), (2160, 3840)]:
+        rle = encode_rle(random_mask(height, width))
+        t_old, old = timeit(decode_rle_bit_string, rle)
+        t_new, new = timeit(decode_rle, rle)
+        assert old.tobytes() == new.tobytes()
+        print(f'{width}x{height}: rle {len(rle)} bytes, bit string {t_old:.3f}s, decode_rle {t_new:.3f}s, '
+              f'speedup x{t_old / max(t_new, 1e-9):.1f}')
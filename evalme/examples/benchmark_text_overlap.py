@@ -0,0 +1,64 @@
+"""
+Benchmark of text spans overlap: prefix growing `_most_common_ends` vs binary search `ends_overlap_ratio`
+"""
+import random
+import time
+
+from evalme.utils import ends_overlap_ratio
+
+
+def most_common_ends(text1, text2):
+    """
+    Previous text overlap growing the common prefix by one character
+    """
+    ind = 0
+    for i in range(1, len(text2)):
+        if text2[:i] in text1:
+            ind = i
+            continue
+        else:
+            break
+    if text1.endswith(text2[:ind]):
+        return ind / (len(text1) + len(text2) - ind)
+    else:
+        return -1
+
+
+def timeit(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def random_paragraph(rng, words=200):
+    vocabulary = ['the', 'a', 'model', 'annotation', 'label', 'span', 'text', 'of', 'in', 'evaluation']
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+
+def overlapping_spans(rng, words=200):
+    """
+    Pairs of spans highlighted in the same paragraph with overlapping ends
+    """
+    paragraph = random_paragraph(rng, words * 2)
+    start = rng.randint(0, len(paragraph) // 2)
+    overlap = rng.randint(1, len(paragraph) // 4)
+    end = start + len(paragraph) // 3
+    return paragraph[start:end], paragraph[end - overlap:end - overlap + len(paragraph) // 3]
+
+
+def scores(func, pairs):
+    return [max(func(x, y), func(y, x)) for x, y in pairs]
+
+
+if __name__ == '__main__':
+    rng = random.Random(0)
+    for words in [50, 200, 1000]:
+        pairs = [overlapping_spans(rng, words) for _ in range(20)]
+        t_old, old = timeit(scores, most_common_ends, pairs)
+        t_new, new = timeit(scores, ends_overlap_ratio, pairs)
+        assert old == new
+        print(f'{words} words spans: _most_common_ends {t_old:.3f}s, ends_overlap_ratio {t_new:.3f}s, '
+              f'speedup x{t_old / max(t_new, 1e-9):.1f}')
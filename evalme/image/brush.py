@@ -1,6 +1,9 @@
+from collections import OrderedDict
+
 import numpy as np
 # This code was copy-pasted from `label_studio_converter.brush.decode_rle` and should be kept in sync with that function.
 # It can be removed if `evalme` is merged into SDK.
+# `decode_rle` reads bits with `BitStream` instead of `InputStream(bytes2bit(rle))`, output is the same.
 
 class InputStream:
     def __init__(self, data):
@@ -25,13 +28,50 @@ def bytes2bit(data):
     return "".join([str(access_bit(data, i)) for i in range(len(data) * 8)])
 
 
+def decode_rle_bit_string(rle):
+    """Reference decoder reading LS RLE from bit string, the same as `label_studio_converter.brush.decode_rle`"""
+    input = InputStream(bytes2bit(rle))
+    num = input.read(32)
+    word_size = input.read(5) + 1
+    rle_sizes = [input.read(4) + 1 for _ in range(4)]
+    i = 0
+    out = np.zeros(num, dtype=np.uint8)
+    while i < num:
+        x = input.read(1)
+        j = i + 1 + input.read(rle_sizes[input.read(2)])
+        if x:
+            out[i:j] = input.read(word_size)
+            i = j
+        else:
+            while i < j:
+                out[i] = input.read(word_size)
+                i += 1
+    return out
+
+
+class BitStream:
+    """Read big-endian bit fields directly from bytes without converting them to a bit string"""
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.i = 0
+
+    def read(self, size):
+        start = self.i >> 3
+        end = (self.i + size + 7) >> 3
+        value = int.from_bytes(self.data[start:end], "big")
+        shift = (end << 3) - self.i - size
+        self.i += size
+        return (value >> shift) & ((1 << size) - 1)
+
+
 def decode_rle(rle, print_params: bool = False):
     """from LS RLE to numpy uint8 3d image [width, height, channel]
 
     Args:
         print_params (bool, optional): If true, a RLE parameters print statement is suppressed
     """
-    input = InputStream(bytes2bit(rle))
+    input = BitStream(rle)
     num = input.read(32)
     word_size = input.read(5) + 1
     rle_sizes = [input.read(4) + 1 for _ in range(4)]
@@ -41,18 +81,225 @@ def decode_rle(rle, print_params: bool = False):
             "RLE params:", num, "values", word_size, "word_size", rle_sizes, "rle_sizes"
         )
 
+    read = input.read
     i = 0
     out = np.zeros(num, dtype=np.uint8)
     while i < num:
-        x = input.read(1)
-        j = i + 1 + input.read(rle_sizes[input.read(2)])
-        if x:
-            val = input.read(word_size)
+        # 1 bit of run type and 2 bits of run length size index
+        header = read(3)
+        j = i + 1 + read(rle_sizes[header & 3])
+        if header >> 2:
+            val = read(word_size)
             out[i:j] = val
             i = j
+        elif word_size == 8:
+            # read all literal bytes at once
+            out[i:j] = np.frombuffer(read(8 * (j - i)).to_bytes(j - i, "big"), dtype=np.uint8)
+            i = j
         else:
             while i < j:
-                val = input.read(word_size)
+                val = read(word_size)
                 out[i] = val
                 i += 1
     return out
+
+
+class MaskRuns:
+    """Decoded mask as sorted non-overlapping runs of nonzero values [start, end)"""
+
+    def __init__(self, size, runs):
+        self.size = size
+        self.runs = runs
+        self.runs.flags.writeable = False
+        self.area = int((runs[:, 1] - runs[:, 0]).sum())
+        self._bboxes = {}
+
+    @property
+    def nbytes(self):
+        return self.runs.nbytes
+
+    def bbox(self, row_size):
+        """Bounding box (row_min, row_max, column_min, column_max) of nonzero values for image rows of row_size"""
+        if row_size not in self._bboxes:
+            starts, ends = self.runs[:, 0], self.runs[:, 1] - 1
+            rows_start, rows_end = starts // row_size, ends // row_size
+            # runs crossing image rows cover all columns
+            single_row = rows_start == rows_end
+            columns_min = np.where(single_row, starts % row_size, 0)
+            columns_max = np.where(single_row, ends % row_size, row_size - 1)
+            self._bboxes[row_size] = (int(rows_start.min()), int(rows_end.max()),
+                                      int(columns_min.min()), int(columns_max.max()))
+        return self._bboxes[row_size]
+
+    def bbox_overlaps(self, other, row_size=None):
+        """Check bounding boxes (or runs extents if row_size is unknown) of nonzero values overlap"""
+        if not self.area or not other.area:
+            return False
+        if self.runs[-1, 1] <= other.runs[0, 0] or other.runs[-1, 1] <= self.runs[0, 0]:
+            return False
+        if not row_size:
+            return True
+        row_min, row_max, column_min, column_max = self.bbox(row_size)
+        other_row_min, other_row_max, other_column_min, other_column_max = other.bbox(row_size)
+        return not (row_max < other_row_min or other_row_max < row_min or
+                    column_max < other_column_min or other_column_max < column_min)
+
+    def intersection(self, other, row_size=None):
+        """Number of values which are nonzero in both masks"""
+        if self.size != other.size:
+            raise ValueError(f"Masks have different sizes {self.size} and {other.size}")
+        if not self.bbox_overlaps(other, row_size):
+            return 0
+        # sweep over runs boundaries, both masks cover the segment where counter is 2
+        positions = np.concatenate([self.runs[:, 0], self.runs[:, 1], other.runs[:, 0], other.runs[:, 1]])
+        n, m = len(self.runs), len(other.runs)
+        deltas = np.concatenate([np.ones(n, dtype=np.int8), -np.ones(n, dtype=np.int8),
+                                 np.ones(m, dtype=np.int8), -np.ones(m, dtype=np.int8)])
+        order = np.argsort(positions, kind="stable")
+        positions = positions[order]
+        counter = np.cumsum(deltas[order])
+        return int(np.diff(positions)[counter[:-1] == 2].sum())
+
+    def iou(self, other, row_size=None):
+        """IOU of nonzero values, masks with not overlapping bounding boxes are compared without runs sweep
+
+        Args:
+            other: MaskRuns to compare with
+            row_size (int, optional): number of values in image row (width * channels)
+        """
+        intersection = self.intersection(other, row_size)
+        union = self.area + other.area - intersection
+        return intersection / max(union, 1)
+
+
+def decode_rle_runs(rle):
+    """from LS RLE to `MaskRuns` of nonzero values without allocating the whole image"""
+    input = BitStream(rle)
+    read = input.read
+    num = read(32)
+    word_size = read(5) + 1
+    rle_sizes = [read(4) + 1 for _ in range(4)]
+
+    starts, ends = [], []
+
+    def add_run(start, end):
+        if ends and ends[-1] == start:
+            ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+
+    i = 0
+    while i < num:
+        header = read(3)
+        j = i + 1 + read(rle_sizes[header & 3])
+        if header >> 2:
+            if read(word_size):
+                add_run(i, j)
+        else:
+            if word_size == 8:
+                values = np.frombuffer(read(8 * (j - i)).to_bytes(j - i, "big"), dtype=np.uint8)
+            else:
+                values = np.array([read(word_size) for _ in range(j - i)])
+            nonzero = np.flatnonzero(values)
+            if len(nonzero):
+                # split nonzero positions into consecutive groups
+                breaks = np.flatnonzero(np.diff(nonzero) != 1) + 1
+                for group_start, group_end in zip(np.r_[0, breaks].tolist(), np.r_[breaks, len(nonzero)].tolist()):
+                    add_run(i + int(nonzero[group_start]), i + int(nonzero[group_end - 1]) + 1)
+        i = j
+    runs = np.array([starts, ends], dtype=np.int64).T.reshape(-1, 2)
+    return MaskRuns(num, np.ascontiguousarray(runs))
+
+
+class DecodedMasksCache:
+    """Process-wide LRU cache of decoded masks keyed by RLE bytes and bounded by total masks size"""
+
+    def __init__(self, decode=decode_rle_runs, max_bytes=0):
+        self.decode = decode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+        self._size = 0
+
+    def get(self, rle):
+        if self.max_bytes <= 0:
+            return self.decode(rle)
+        key = bytes(rle)
+        mask = self._masks.get(key)
+        if mask is not None:
+            self.hits += 1
+            self._masks.move_to_end(key)
+            return mask
+        self.misses += 1
+        mask = self.decode(key)
+        if mask.nbytes <= self.max_bytes:
+            self._masks[key] = mask
+            self._size += mask.nbytes
+            while self._size > self.max_bytes:
+                _, evicted = self._masks.popitem(last=False)
+                self._size -= evicted.nbytes
+        return mask
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        while self._masks and self._size > max(max_bytes, 0):
+            _, evicted = self._masks.popitem(last=False)
+            self._size -= evicted.nbytes
+
+    def clear(self):
+        self._masks.clear()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+
+# cache is disabled by default, enable with `.resize(max_bytes)`
+decoded_runs_cache = DecodedMasksCache(decode_rle_runs)
+
+
+def decode_rle_runs_cached(rle):
+    """`decode_rle_runs` through the process-wide decoded runs cache"""
+    return decoded_runs_cache.get(rle)
+
+
+def encode_rle(arr, word_size=8, rle_sizes=(3, 4, 8, 16)):
+    """from numpy uint8 array to LS RLE, inverse of `decode_rle`
+
+    Args:
+        arr: image values, flattened before encoding
+        word_size (int, optional): bits per value
+        rle_sizes (tuple, optional): bits for run lengths
+    """
+    arr = np.asarray(arr, dtype=np.uint8).ravel()
+    num = len(arr)
+    bits = [f"{num:032b}", f"{word_size - 1:05b}"] + [f"{size - 1:04b}" for size in rle_sizes]
+
+    def length_bits(length):
+        index = next(k for k, size in enumerate(rle_sizes) if length - 1 < (1 << size))
+        return f"{index:02b}{length - 1:0{rle_sizes[index]}b}"
+
+    max_length = 1 << rle_sizes[-1]
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(arr)) + 1, [num]]).tolist()
+    literal = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end - start == 1 and len(literal) < max_length:
+            # single values are grouped into literal runs
+            literal.append(int(arr[start]))
+            continue
+        if literal:
+            bits.append("0" + length_bits(len(literal)) + "".join(f"{v:0{word_size}b}" for v in literal))
+            literal = []
+        if end - start == 1:
+            literal.append(int(arr[start]))
+            continue
+        while start < end:
+            length = min(end - start, max_length)
+            bits.append("1" + length_bits(length) + f"{int(arr[start]):0{word_size}b}")
+            start += length
+    if literal:
+        bits.append("0" + length_bits(len(literal)) + "".join(f"{v:0{word_size}b}" for v in literal))
+    out = "".join(bits)
+    out += "0" * (-len(out) % 8)
+    return [int(out[k:k + 8], 2) for k in range(0, len(out), 8)]
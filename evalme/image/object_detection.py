@@ -1,24 +1,29 @@
 import itertools
-import re
-import random
 
 import numpy
 import numpy as np
 
 from collections import defaultdict, Counter
 
-from evalme.image.brush import decode_rle
-from shapely.geometry import Polygon, MultiPolygon, LineString
-from shapely.ops import unary_union, polygonize
+import shapely
+from scipy.optimize import linear_sum_assignment
+
+from evalme.image.brush import decode_rle_runs_cached
 
 from evalme.eval_item import EvalItem
-from evalme.utils import get_text_comparator, texts_similarity, Result
-from shapely.validation import explain_validity
-from shapely.validation import make_valid
+from evalme.utils import get_text_comparator, texts_similarity, Result, bounds_overlap, PolygonsCache, _try_build_poly, \
+    _hashable
 
 from evalme.text.text import TextAreaEvalItem
 
 
+# IOU thresholds 0.5:0.95 with 0.05 step
+COCO_IOU_THRESHOLDS = numpy.linspace(0.5, 0.95, 10)
+
+# shapely 2 has STRtree queries and vectorized geometry operations
+SHAPELY_VECTORIZED = int(shapely.__version__.split('.')[0]) >= 2
+
+
 class ObjectDetectionEvalItem(EvalItem):
     SHAPE_KEY = 'undefined'
 
@@ -45,6 +50,53 @@ class ObjectDetectionEvalItem(EvalItem):
         # return the intersection over union value
         return iou
 
+    def _iou_matrix(self, item, mask=None):
+        """
+        IOU between each shape of self (rows) and each shape of item (columns)
+        :param item: to be compared with self
+        :param mask: bool matrix of pairs to compute IOU for, other pairs are 0
+        :return: np.array(n, m)
+        """
+        values = self.get_values()
+        item_values = item.get_values()
+        matrix = np.zeros((len(values), len(item_values)), dtype=np.float64)
+        if mask is None:
+            pairs = itertools.product(range(len(values)), range(len(item_values)))
+        else:
+            pairs = zip(*np.nonzero(mask))
+        for i, j in pairs:
+            matrix[i, j] = self._iou(values[i], item_values[j])
+        return matrix
+
+    def _labels_codes(self, item):
+        """
+        Labels of shapes encoded once, shapes with identical labels have the same code
+        :param item: to be compared with self
+        :return: np.array(n) of self codes, np.array(m) of item codes
+        """
+        codes = {}
+        rows = [codes.setdefault(_hashable(x[self._shape_key]), len(codes)) for x in self.get_values_iter()]
+        cols = [codes.setdefault(_hashable(y[self._shape_key]), len(codes)) for y in item.get_values_iter()]
+        return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+    def _labels_match_matrix(self, item, comparator=None):
+        """
+        Labels matching between each shape of self (rows) and each shape of item (columns)
+        :param item: to be compared with self
+        :param comparator: text comparator, labels are matched by equality if not set
+        :return: bool np.array(n, m)
+        """
+        if comparator is None:
+            rows, cols = self._labels_codes(item)
+            return rows[:, None] == cols[None, :]
+        values = self.get_values()
+        item_values = item.get_values()
+        matrix = np.zeros((len(values), len(item_values)), dtype=bool)
+        for i, x in enumerate(values):
+            for j, y in enumerate(item_values):
+                matrix[i, j] = texts_similarity(x[self._shape_key], y[self._shape_key], comparator) != 0
+        return matrix
+
     def total_iou(self, item, label_weights=None, algorithm=None, qval=None, per_label=False):
         """
         For each shape in current eval item, we compute IOU with identically labeled shape with largest intersection.
@@ -63,14 +115,9 @@ class ObjectDetectionEvalItem(EvalItem):
         else:
             ious, weights = [], []
         comparator = get_text_comparator(algorithm, qval)
-        for gt in self.get_values_iter():
-            max_iou = 0
-            for pred in item.get_values_iter():
-                label_sim = texts_similarity(gt[self._shape_key], pred[self._shape_key], comparator)
-                if label_sim == 0:
-                    continue
-                iou = self._iou(gt, pred)
-                max_iou = max(iou, max_iou)
+        labels_match = self._labels_match_matrix(item, comparator)
+        max_ious = np.where(labels_match, self._iou_matrix(item, mask=labels_match), 0).max(axis=1, initial=0)
+        for gt, max_iou in zip(self.get_values_iter(), max_ious.tolist()):
             if per_label:
                 for l in gt[self._shape_key]:
                     ious[l].append(max_iou)
@@ -82,74 +129,91 @@ class ObjectDetectionEvalItem(EvalItem):
             return {l: float(np.mean(v)) for l, v in ious.items()}
         return np.average(ious, weights=weights) if ious else 0.0
 
-    def _precision_recall_at_iou_per_label(self, item, iou_threshold):
+    def _precision_recall_at_ious(self, item, iou_thresholds, label_weights=None, per_label=False):
         """
-        :return: precision dict {label: float[0..1]}
-                 recall dict {label: float[0..1]}
+        Precision and recall for all IOU thresholds from a single IOU matrix
+        :param item: to be compared with self
+        :param iou_thresholds: list of IOU thresholds
+        :param label_weights: weight of particular label
+        :param per_label: calculate per label or overall
+        :return: list of (precision, recall) tuples for each threshold
         """
         shapes = item.get_values()
-        tp, fp, fn = defaultdict(int), defaultdict(int), defaultdict(int)
-
-        def inc_counters(c, labels):
-            for l in labels:
-                c[l] += 1
-
-        all_labels = set()
-        for shape_pred in self.get_values_iter():
-            [all_labels.add(l) for l in shape_pred[self._shape_key]]
-            for shape_gt in shapes:
-                [all_labels.add(l) for l in shape_gt[self._shape_key]]
-                iou = self._iou(shape_pred, shape_gt)
-                if shape_pred[self._shape_key] == shape_gt[self._shape_key]:
-                    if iou >= iou_threshold:
-                        # IOU > t with matching labels => true positive
-                        inc_counters(tp, shape_gt[self._shape_key])
-                    else:
-                        # IOU < t with matching labels => false negative
-                        inc_counters(fn, shape_gt[self._shape_key])
-                else:
-                    if iou >= iou_threshold:
-                        # IOU > t with non-matching labels => false positive
-                        inc_counters(fp, shape_gt[self._shape_key])
-
-        precision, recall = {}, {}
-        for l in all_labels:
-            totalp = tp[l] + fp[l]
-            total_true = tp[l] + fp[l]
-            precision[l] = tp[l] / totalp if totalp > 0 else 0
-            recall[l] = tp[l] / total_true if total_true > 0 else 0
-        return precision, recall
-
-    def _precision_recall_at_iou(self, item, iou_threshold, label_weights=None, per_label=False):
+        labels_match = self._labels_match_matrix(item)[:, :, None]
+        above = self._iou_matrix(item)[:, :, None] >= np.asarray(iou_thresholds, dtype=np.float64)[None, None, :]
+        # IOU > t with matching labels => true positive
+        tp_pairs = labels_match & above
+        # IOU < t with matching labels => false negative
+        fn_pairs = labels_match & ~above
+        # IOU > t with non-matching labels => false positive
+        fp_pairs = ~labels_match & above
 
         if per_label:
             # it's identical except that it returns per-label scores rather than averaged
-            return self._precision_recall_at_iou_per_label(item, iou_threshold)
+            return self._precision_recall_per_label(shapes, tp_pairs, fn_pairs, fp_pairs)
 
-        shapes = item.get_values()
-        tp, fp, fn = 0, 0, 0
         label_weights = label_weights or {}
-
+        weights = []
+        for shape_gt in shapes:
+            if self._shape_key in shape_gt:
+                weights.append(sum(label_weights.get(l, 1) for l in shape_gt[self._shape_key]))
+            else:
+                weights.append(1)
+        weights = np.broadcast_to(np.array(weights).reshape(1, -1), above.shape[:2])
+        results = []
+        for t in range(above.shape[2]):
+            # weights are summed in pairs order to keep exactly the same score
+            tp = sum(weights[tp_pairs[:, :, t]].tolist())
+            fn = sum(weights[fn_pairs[:, :, t]].tolist())
+            fp = sum(weights[fp_pairs[:, :, t]].tolist())
+            totalp = tp + fp
+            total_true = tp + fn
+            precision = tp / totalp if totalp > 0 else 0
+            recall = tp / total_true if total_true > 0 else 0
+            results.append((precision, recall))
+        return results
+
+    def _precision_recall_per_label(self, shapes, tp_pairs, fn_pairs, fp_pairs):
+        """
+        :return: list of (precision dict {label: float[0..1]}, recall dict {label: float[0..1]}) for each threshold
+        """
+        all_labels = set()
         for shape_pred in self.get_values_iter():
+            all_labels.update(shape_pred[self._shape_key])
+        if not self.empty:
             for shape_gt in shapes:
-                iou = self._iou(shape_pred, shape_gt)
-                if self._shape_key in shape_gt:
-                    weight = sum(label_weights.get(l, 1) for l in shape_gt[self._shape_key])
-                else:
-                    weight = 1
-                if shape_pred[self._shape_key] == shape_gt[self._shape_key]:
-                    if iou >= iou_threshold:
-                        tp += weight
-                    else:
-                        fn += weight
-                else:
-                    if iou >= iou_threshold:
-                        fp += weight
-        totalp = tp + fp
-        total_true = tp + fn
-        precision = tp / totalp if totalp > 0 else 0
-        recall = tp / total_true if total_true > 0 else 0
-        return precision, recall
+                all_labels.update(shape_gt[self._shape_key])
+
+        # counters per each gt shape and threshold
+        tp_counts = tp_pairs.sum(axis=0).tolist()
+        fn_counts = fn_pairs.sum(axis=0).tolist()
+        fp_counts = fp_pairs.sum(axis=0).tolist()
+        results = []
+        for t in range(tp_pairs.shape[2]):
+            tp, fp, fn = defaultdict(int), defaultdict(int), defaultdict(int)
+            for j, shape_gt in enumerate(shapes):
+                for l in shape_gt[self._shape_key]:
+                    tp[l] += tp_counts[j][t]
+                    fn[l] += fn_counts[j][t]
+                    fp[l] += fp_counts[j][t]
+            precision, recall = {}, {}
+            for l in all_labels:
+                totalp = tp[l] + fp[l]
+                total_true = tp[l] + fp[l]
+                precision[l] = tp[l] / totalp if totalp > 0 else 0
+                recall[l] = tp[l] / total_true if total_true > 0 else 0
+            results.append((precision, recall))
+        return results
+
+    def _precision_recall_at_iou_per_label(self, item, iou_threshold):
+        """
+        :return: precision dict {label: float[0..1]}
+                 recall dict {label: float[0..1]}
+        """
+        return self._precision_recall_at_ious(item, [iou_threshold], per_label=True)[0]
+
+    def _precision_recall_at_iou(self, item, iou_threshold, label_weights=None, per_label=False):
+        return self._precision_recall_at_ious(item, [iou_threshold], label_weights, per_label)[0]
 
     def prediction_result_at_iou_for_all_bbox(self, item, iou_threshold=0.5):
         """
@@ -172,14 +236,13 @@ class ObjectDetectionEvalItem(EvalItem):
                 if gt_count[key] < pred_count[key]:
                     return Result.FP
 
+        labels_match = self._labels_match_matrix(item)
+        ious = self._iou_matrix(item, mask=labels_match)
         for i in range(len(gt)):
-            shape_gt = gt[i]
-            max_iou = -1
-            for shape_pred in pred:
-                if shape_pred[self._shape_key] == shape_gt[self._shape_key]:
-                    iou = self._iou(shape_gt, shape_pred)
-                    max_iou = max(iou, max_iou)
-            results[i] = max_iou
+            if labels_match[i].any():
+                results[i] = max(ious[i][labels_match[i]].max().item(), -1)
+            else:
+                results[i] = -1
 
         if all(val >= iou_threshold for val in results.values()):
             return Result.TP
@@ -202,6 +265,10 @@ class ObjectDetectionEvalItem(EvalItem):
 
     def f1_at_iou(self, item, iou_threshold=0.5, label_weights=None, per_label=False):
         precision, recall = self._precision_recall_at_iou(item, iou_threshold, label_weights, per_label)
+        return self._f1(precision, recall, per_label)
+
+    @staticmethod
+    def _f1(precision, recall, per_label=False):
         if per_label:
             out = {}
             for l in precision:
@@ -216,16 +283,118 @@ class ObjectDetectionEvalItem(EvalItem):
             return 0
         return 2 * precision * recall / (precision + recall)
 
-    def mAP_at_iou(self, item, iou_threshold=0.5, label_weights=None, per_label=False):
+    def _assignment(self, item):
+        """
+        Optimal one-to-one matching of identically labeled shapes maximizing total IOU,
+        solved separately for each set of labels
+        :param item: to be compared with self
+        :return: np.array(k) of self shapes, np.array(k) of matched item shapes, np.array(k) of their IOU
+        """
+        rows_codes, cols_codes = self._labels_codes(item)
+        ious = self._iou_matrix(item, mask=rows_codes[:, None] == cols_codes[None, :])
+        rows, cols = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for code in np.intersect1d(rows_codes, cols_codes):
+            block_rows = np.flatnonzero(rows_codes == code)
+            block_cols = np.flatnonzero(cols_codes == code)
+            r, c = linear_sum_assignment(ious[np.ix_(block_rows, block_cols)], maximize=True)
+            rows.append(block_rows[r])
+            cols.append(block_cols[c])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        matched = ious[rows, cols] > 0
+        return rows[matched], cols[matched], ious[rows, cols][matched]
+
+    def _shape_weights(self, label_weights):
+        label_weights = label_weights or {}
+        return [sum(label_weights.get(l, 1) for l in shape[self._shape_key]) for shape in self.get_values_iter()]
+
+    def assignment_iou(self, item, label_weights=None, per_label=False):
+        """
+        For each shape in current eval item, IOU with identically labeled shape assigned by optimal one-to-one
+        matching, 0 for not matched shapes. Unlike `total_iou` a shape from item is matched at most once
+        :param item: to be compared with self
+        :param label_weights: weight of particular label
+        :param per_label: calculate per label or overall
+        :return: float[0..1] or dict {label: float[0..1]}
+        """
+        rows, _, matched_ious = self._assignment(item)
+        ious = np.zeros(len(self), dtype=np.float64)
+        ious[rows] = matched_ious
+        if per_label:
+            per_label_ious = defaultdict(list)
+            for shape, iou in zip(self.get_values_iter(), ious.tolist()):
+                for l in shape[self._shape_key]:
+                    per_label_ious[l].append(iou)
+            return {l: float(np.mean(v)) for l, v in per_label_ious.items()}
+        return np.average(ious, weights=self._shape_weights(label_weights)) if len(ious) else 0.0
+
+    def _assignment_precision_recall_at_iou(self, item, iou_threshold=0.5, label_weights=None, per_label=False):
+        """
+        Precision and recall of shapes matched by optimal one-to-one assignment with IOU >= iou_threshold,
+        current eval item shapes are predictions and item shapes are ground truth
+        :return: precision float[0..1] or dict {label: float[0..1]}
+                 recall float[0..1] or dict {label: float[0..1]}
+        """
+        rows, _, ious = self._assignment(item)
+        rows = rows[ious >= iou_threshold]
+        if per_label:
+            tp, total_pred, total_true = defaultdict(int), defaultdict(int), defaultdict(int)
+            for shape in self.get_values_iter():
+                for l in shape[self._shape_key]:
+                    total_pred[l] += 1
+            for shape in item.get_values_iter():
+                for l in shape[self._shape_key]:
+                    total_true[l] += 1
+            values = self.get_values()
+            for i in rows.tolist():
+                for l in values[i][self._shape_key]:
+                    tp[l] += 1
+            labels = set(total_pred) | set(total_true)
+            precision = {l: tp[l] / total_pred[l] if total_pred[l] > 0 else 0 for l in labels}
+            recall = {l: tp[l] / total_true[l] if total_true[l] > 0 else 0 for l in labels}
+            return precision, recall
+        # matched shapes have the same labels, so the same weights
+        weights = self._shape_weights(label_weights)
+        tp = sum(weights[i] for i in rows.tolist())
+        total_pred = sum(weights)
+        total_true = sum(item._shape_weights(label_weights))
+        precision = tp / total_pred if total_pred > 0 else 0
+        recall = tp / total_true if total_true > 0 else 0
+        return precision, recall
+
+    def assignment_precision_at_iou(self, item, iou_threshold=0.5, label_weights=None, per_label=False):
+        precision, _ = self._assignment_precision_recall_at_iou(item, iou_threshold, label_weights, per_label)
+        return precision
+
+    def assignment_recall_at_iou(self, item, iou_threshold=0.5, label_weights=None, per_label=False):
+        _, recall = self._assignment_precision_recall_at_iou(item, iou_threshold, label_weights, per_label)
+        return recall
+
+    def assignment_f1_at_iou(self, item, iou_threshold=0.5, label_weights=None, per_label=False):
+        precision, recall = self._assignment_precision_recall_at_iou(item, iou_threshold, label_weights, per_label)
+        return self._f1(precision, recall, per_label)
+
+    def mAP_at_iou(self, item, iou_threshold=0.5, label_weights=None, per_label=False, coco=False):
+        """
+        Mean average precision over IOU thresholds sweep
+        :param item: to be compared with self
+        :param iou_threshold: upper bound of thresholds sweep starting from 0.2 with 0.05 step
+        :param label_weights: weight of particular label
+        :param per_label: calculate per label or overall
+        :param coco: use COCO-style 0.5:0.95 thresholds sweep instead
+        :return: float[0..1] or dict {label: float[0..1]}
+        """
         if per_label:
             precisions = defaultdict(list)
             recalls = defaultdict(list)
         else:
             precisions = []
             recalls = []
-        thresholds = numpy.arange(start=0.2, stop=iou_threshold, step=0.05)
-        for threshold in thresholds:
-            precision, recall = self._precision_recall_at_iou(item, threshold, label_weights, per_label)
+        if coco:
+            thresholds = COCO_IOU_THRESHOLDS
+        else:
+            thresholds = numpy.arange(start=0.2, stop=iou_threshold, step=0.05)
+        # IOU matrix is computed once for all thresholds
+        for precision, recall in self._precision_recall_at_ious(item, thresholds, label_weights, per_label):
             if per_label:
                 for label in precision:
                     precisions[label].append(precision[label])
@@ -265,12 +434,14 @@ class ObjectDetectionEvalItem(EvalItem):
         label_weights = label_weights or {}
         ious = []
         comparator = get_text_comparator(algorithm, qval)
-        for gt in self.get_values_iter():
-            for pred in item.get_values_iter():
-                label_sim = texts_similarity(gt[self._shape_key], pred[self._shape_key], comparator)
-                if label_sim == 0:
+        labels_match = self._labels_match_matrix(item, comparator)
+        iou_matrix = self._iou_matrix(item, mask=labels_match)
+        item_values = item.get_values()
+        for i, gt in enumerate(self.get_values_iter()):
+            for j, pred in enumerate(item_values):
+                if not labels_match[i, j]:
                     continue
-                iou = self._iou(gt, pred)
+                iou = iou_matrix[i, j].item()
                 weight = sum(label_weights.get(l, 1) for l in gt[self._shape_key])
                 result = dict()
                 result['iou'] = iou * weight
@@ -284,110 +455,95 @@ class ObjectDetectionEvalItem(EvalItem):
 class BboxObjectDetectionEvalItem(ObjectDetectionEvalItem):
     SHAPE_KEY = 'rectanglelabels'
 
+    def __init__(self, raw_data, shape_key=None, **kwargs):
+        super(BboxObjectDetectionEvalItem, self).__init__(raw_data, shape_key=shape_key, **kwargs)
+        self._bboxes = None
+
+    def _bboxes_array(self):
+        """
+        Bounding boxes converted once to np.array(n, 4) of [x_min, y_min, x_max, y_max] and np.array(n) of areas
+        """
+        if self._bboxes is None:
+            values = self.get_values()
+            xywh = np.array([[v['x'], v['y'], v['width'], v['height']] for v in values],
+                            dtype=np.float64).reshape(-1, 4)
+            boxes = np.concatenate([xywh[:, :2], xywh[:, :2] + xywh[:, 2:]], axis=1)
+            self._bboxes = boxes, xywh[:, 2] * xywh[:, 3]
+        return self._bboxes
+
+    def _iou_matrix(self, item, mask=None):
+        if not isinstance(item, BboxObjectDetectionEvalItem):
+            return super(BboxObjectDetectionEvalItem, self)._iou_matrix(item, mask=mask)
+        boxes, areas = self._bboxes_array()
+        item_boxes, item_areas = item._bboxes_array()
+        # determine the (x, y)-coordinates of the intersection rectangles
+        x_a = np.maximum(boxes[:, None, 0], item_boxes[None, :, 0])
+        y_a = np.maximum(boxes[:, None, 1], item_boxes[None, :, 1])
+        x_b = np.minimum(boxes[:, None, 2], item_boxes[None, :, 2])
+        y_b = np.minimum(boxes[:, None, 3], item_boxes[None, :, 3])
+        inter_area = np.maximum(0, x_b - x_a) * np.maximum(0, y_b - y_a)
+        union = areas[:, None] + item_areas[None, :] - inter_area
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(union != 0, inter_area / union, 0.)
+
 
 class PolygonObjectDetectionEvalItem(ObjectDetectionEvalItem):
 
     SHAPE_KEY = 'polygonlabels'
 
-    def _area_close(self, p1, p2, distance=0.1):
-        return abs(p1.area / max(p2.area, 1e-8) - 1) < distance
+    def __init__(self, raw_data, shape_key=None, **kwargs):
+        super(PolygonObjectDetectionEvalItem, self).__init__(raw_data, shape_key=shape_key, **kwargs)
+        self._polygons = PolygonsCache(self._try_build_poly)
 
     def _try_build_poly(self, points):
-        poly = Polygon(points)
-        # Everything is OK, points are valid polygon
-        if poly.is_valid:
-            return poly
-        # try making valid polygon
-        poly = make_valid(poly)
-        if poly.is_valid:
-            return poly
-
-        # Polygon contains small bowties, we can fix them:
-        # (https://stackoverflow.com/questions/13062334/polygon-intersection-error-in-shapely-shapely-geos-topologicalerror-the-opera)
-        fixed_poly = poly.buffer(0)
-        if not fixed_poly.geom_type == 'MultiPolygon' and self._area_close(fixed_poly, poly):
-            return fixed_poly
-
-        # Trying to build multiple polygons from self intersected polygon
-        line_non_simple = LineString(points)
-        mls = unary_union(line_non_simple)
-        polygons = list(polygonize(mls))
-        multi_poly = MultiPolygon(polygons)
-        if len(polygons) and multi_poly.is_valid:
-            return multi_poly
-
-        # Trying to draw convex hull
-        convex_hull = poly.convex_hull
-        if self._area_close(convex_hull, poly):
-            return convex_hull
-        # trying to fix polygon with dilation
-        distance = 0.01
-        while distance < 11:
-            fixed_poly = poly.buffer(distance)
-            flag = self._area_close(fixed_poly, poly)
-            if fixed_poly.is_valid and flag:
-                return fixed_poly
-            else:
-                distance = distance * 2
-
-        # trying to fix polygon with errosion
-        distance = -0.01
-        while distance > -11:
-            fixed_poly = poly.buffer(distance)
-            flag = self._area_close(fixed_poly, poly)
-            if fixed_poly.is_valid and flag:
-                return fixed_poly
-            else:
-                distance = distance * 2
-
-        # trying to delete points near loop
-        poly1 = self._remove_points(poly, points)
-        if poly1.is_valid and self._area_close(poly1, poly):
-            return poly1
-
-        # We are failing to build polygon, this shall be reported via error log
-        raise ValueError(f'Fail to build polygon from {points}')
-
-    def _remove_points(self, poly, points):
-        """
-        Trying to remove some points to make polygon valid
-        """
-        removed_points = []
-        invalidity = explain_validity(poly)
-        for i in range(len(points)-4):
-            match = re.findall("\d+\.\d+", invalidity)
-            min_distance = poly.area
-            min_point = None
-            if match:
-                intersect_point = (float(match[0]), float(match[1]))
-                for point in points:
-                    distance = abs(point[0] - intersect_point[0]) + abs(point[1] - intersect_point[1])
-                    if distance < min_distance:
-                        min_distance = distance
-                        min_point = point
-                removed_points.append(min_point)
-                points.remove(min_point)
-                poly1 = Polygon(points)
-            if poly1.is_valid:
-                break
-            invalidity = explain_validity(poly1)
-        if self._area_close(poly, poly1):
-            return poly1
-        random.shuffle(removed_points)
-        for item in removed_points:
-            points.append(item)
-            poly2 = Polygon(points)
-            poly2 = poly2.buffer(0)
-            if poly2.is_valid:
-                continue
-            else:
-                points.remove(item)
-        return poly2
+        # repair stages can be limited with `polygon_repair_stages` param,
+        # polygons built by each stage are counted into optional `polygon_repair_stats` Counter
+        return _try_build_poly(points, self._kwargs.get('polygon_repair_stages'),
+                               self._kwargs.get('polygon_repair_stats'))
+
+    def _geometries(self, indices=None):
+        """
+        Array of built polygons, None for shapes without points or not in indices
+        :param indices: bool array of shapes to build polygons for, all shapes if not set
+        :return: np.array(n) of shapely geometries
+        """
+        values = self.get_values()
+        geometries = np.full(len(values), None, dtype=object)
+        for i, value in enumerate(values):
+            if value.get('points') and (indices is None or indices[i]):
+                geometries[i] = self._polygons.get(value['points'])
+        return geometries
+
+    def _iou_matrix(self, item, mask=None):
+        if not SHAPELY_VECTORIZED or not isinstance(item, PolygonObjectDetectionEvalItem):
+            return super(PolygonObjectDetectionEvalItem, self)._iou_matrix(item, mask=mask)
+        matrix = np.zeros((len(self), len(item)), dtype=np.float64)
+        if not matrix.size:
+            return matrix
+        geometries = self._geometries(None if mask is None else mask.any(axis=1))
+        item_geometries = item._geometries(None if mask is None else mask.any(axis=0))
+        # candidate pairs are the ones with intersecting geometries, IOU of other pairs is 0
+        tree = shapely.STRtree(item_geometries)
+        rows, columns = tree.query(geometries, predicate='intersects')
+        if mask is not None:
+            selected = mask[rows, columns]
+            rows, columns = rows[selected], columns[selected]
+        if not len(rows):
+            return matrix
+        a, b = geometries[rows], item_geometries[columns]
+        inter_area = shapely.area(shapely.intersection(a, b))
+        union = shapely.area(a) + shapely.area(b) - inter_area
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matrix[rows, columns] = np.where(union != 0, inter_area / union, 0.)
+        return matrix
 
     def _iou(self, polyA, polyB):
         if polyA.get('points') and polyB.get('points'):
-            pA = self._try_build_poly(polyA['points'])
-            pB = self._try_build_poly(polyB['points'])
+            # polygons are built once per item and reused for all pairs
+            pA = self._polygons.get(polyA['points'])
+            pB = self._polygons.get(polyB['points'])
+            if not bounds_overlap(pA.bounds, pB.bounds):
+                return 0
             inter_area = pA.intersection(pB).area
             iou = inter_area / (pA.area + pB.area - inter_area)
         else:
@@ -510,7 +666,10 @@ class OCREvalItem(ObjectDetectionEvalItem):
                             # check if there are text tags in prediction
                             text_tag_in_result = [item for item in pred_types if
                                                       item != 'labels' and item not in OCREvalItem.OCR_SHAPES]
-                            if not text_tag_in_result:
+                            if not label_distance:
+                                # text distance doesn't matter for different labels
+                                text_distance = 0
+                            elif not text_tag_in_result:
                                 # check if there are text tags in ground truth
                                 text_tag_in_gt = [item for item in gt_types if
                                                   item != 'labels' and item not in OCREvalItem.OCR_SHAPES]
@@ -625,25 +784,56 @@ class OCREvalItem(ObjectDetectionEvalItem):
 class BrushEvalItem(ObjectDetectionEvalItem):
     SHAPE_KEY = 'brushlabels'
 
+    def __init__(self, raw_data, shape_key=None, **kwargs):
+        super(BrushEvalItem, self).__init__(raw_data, shape_key=shape_key, **kwargs)
+        self._masks = {}
+
+    def _mask(self, index):
+        """
+        Decoded mask runs of shape by index, each mask is decoded once per item
+        """
+        if index not in self._masks:
+            self._masks[index] = decode_rle_runs_cached(self._raw_data[index]['value']['rle'])
+        return self._masks[index]
+
+    def _row_size(self, index):
+        """
+        Number of mask values in image row, None if image width is unknown
+        """
+        width = self._raw_data[index].get('original_width')
+        return width * 4 if width else None
+
+    @staticmethod
+    def _masks_iou(gt, pred, row_size=None):
+        # IOU is computed on runs of nonzero values, memory scales with the number of runs
+        return gt.iou(pred, row_size)
+
     @staticmethod
     def _iou(gt, pred):
-        gt = decode_rle(gt['rle'])
-        pred = decode_rle(pred['rle'])
-        union = np.logical_or(gt, pred).sum()
-        intersection = np.logical_and(gt, pred).sum()
-        return intersection / max(union, 1)
+        return BrushEvalItem._masks_iou(decode_rle_runs_cached(gt['rle']), decode_rle_runs_cached(pred['rle']))
+
+    def _iou_matrix(self, item, mask=None):
+        if not isinstance(item, BrushEvalItem):
+            return super(BrushEvalItem, self)._iou_matrix(item, mask=mask)
+        matrix = np.zeros((len(self), len(item)), dtype=np.float64)
+        if mask is None:
+            pairs = itertools.product(range(len(self)), range(len(item)))
+        else:
+            pairs = zip(*np.nonzero(mask))
+        for i, j in pairs:
+            matrix[i, j] = self._masks_iou(self._mask(i), item._mask(j), self._row_size(i))
+        return matrix
 
     def iou(self, pred_item, per_label=False, label_weights=None):
         if per_label:
             ious = defaultdict(list)
         else:
             ious, weights = [], []
-        for gt in self.get_values_iter():
+        for i, gt in enumerate(self.get_values_iter()):
             max_iou = 0
-            for pred in pred_item.get_values_iter():
-                if not gt[self._shape_key] == pred[self._shape_key]:
-                    continue
-                iou = self._iou(gt, pred)
+            # only identically labeled shapes are compared
+            for j in pred_item._labels_index().get(self._labels_key(gt), []):
+                iou = self._masks_iou(self._mask(i), pred_item._mask(j), self._row_size(i))
                 max_iou = max(iou, max_iou)
             if per_label:
                 for l in gt[self._shape_key]:
@@ -809,10 +999,101 @@ def f1_polygons(item_gt,
     return item_pred.f1_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
 
 
-def mAP_bboxes(item_gt, item_pred, iou_threshold=0.5, label_weights=None, shape_key=None, per_label=False, **kwargs):
+def iou_bboxes_assignment(item_gt, item_pred, label_weights=None, shape_key=None, per_label=False, **kwargs):
+    item_gt = _as_bboxes(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_bboxes(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.assignment_iou(item_gt, label_weights, per_label=per_label)
+
+
+def precision_bboxes_assignment(item_gt,
+                                item_pred,
+                                iou_threshold=0.5,
+                                label_weights=None,
+                                shape_key=None,
+                                per_label=False,
+                                **kwargs):
     item_gt = _as_bboxes(item_gt, shape_key=shape_key, **kwargs)
     item_pred = _as_bboxes(item_pred, shape_key=shape_key, **kwargs)
-    return item_pred.mAP_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
+    return item_pred.assignment_precision_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
+
+
+def recall_bboxes_assignment(item_gt,
+                             item_pred,
+                             iou_threshold=0.5,
+                             label_weights=None,
+                             shape_key=None,
+                             per_label=False,
+                             **kwargs):
+    item_gt = _as_bboxes(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_bboxes(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.assignment_recall_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
+
+
+def f1_bboxes_assignment(item_gt,
+                         item_pred,
+                         iou_threshold=0.5,
+                         label_weights=None,
+                         shape_key=None,
+                         per_label=False,
+                         **kwargs):
+    item_gt = _as_bboxes(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_bboxes(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.assignment_f1_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
+
+
+def iou_polygons_assignment(item_gt, item_pred, label_weights=None, shape_key=None, per_label=False, **kwargs):
+    item_gt = _as_polygons(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_polygons(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.assignment_iou(item_gt, label_weights, per_label=per_label)
+
+
+def precision_polygons_assignment(item_gt,
+                                  item_pred,
+                                  iou_threshold=0.5,
+                                  label_weights=None,
+                                  shape_key=None,
+                                  per_label=False,
+                                  **kwargs):
+    item_gt = _as_polygons(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_polygons(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.assignment_precision_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
+
+
+def recall_polygons_assignment(item_gt,
+                               item_pred,
+                               iou_threshold=0.5,
+                               label_weights=None,
+                               shape_key=None,
+                               per_label=False,
+                               **kwargs):
+    item_gt = _as_polygons(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_polygons(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.assignment_recall_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
+
+
+def f1_polygons_assignment(item_gt,
+                           item_pred,
+                           iou_threshold=0.5,
+                           label_weights=None,
+                           shape_key=None,
+                           per_label=False,
+                           **kwargs):
+    item_gt = _as_polygons(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_polygons(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.assignment_f1_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label)
+
+
+def mAP_bboxes(item_gt, item_pred, iou_threshold=0.5, label_weights=None, shape_key=None, per_label=False,
+               coco=False, **kwargs):
+    item_gt = _as_bboxes(item_gt, shape_key=shape_key, **kwargs)
+    item_pred = _as_bboxes(item_pred, shape_key=shape_key, **kwargs)
+    return item_pred.mAP_at_iou(item_gt, iou_threshold, label_weights, per_label=per_label, coco=coco)
+
+
+def mAP_bboxes_coco(item_gt, item_pred, label_weights=None, shape_key=None, per_label=False, **kwargs):
+    kwargs.pop('iou_threshold', None)
+    return mAP_bboxes(item_gt, item_pred, label_weights=label_weights, shape_key=shape_key, per_label=per_label,
+                      coco=True, **kwargs)
 
 
 def prediction_bboxes(item_gt, item_pred, iou_threshold=0.5, shape_key=None, **kwargs):
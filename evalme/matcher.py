@@ -1,9 +1,14 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from functools import partial
+from itertools import islice, takewhile
 
 import numpy as np
 import requests
 import json
 import logging
+import re
 
 from evalme.image.object_detection import prediction_bboxes, matrix_iou_bboxes
 from evalme.metrics import Metrics
@@ -11,6 +16,80 @@ from evalme.utils import calculate_ap
 
 logger = logging.getLogger(__name__)
 
+TASKS_SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+def init_worker(metrics):
+    """
+    Register metrics in worker process, processes started by spawn or forkserver
+    don't have metrics registered at runtime in the main process
+    :param metrics: Metrics registry of the main process (Metrics._metrics)
+    """
+    Metrics._metrics.update(metrics)
+
+
+class TasksStream:
+    """
+    Tasks from Label Studio export file iterated incrementally with bounded memory
+    Supports JSON array and JSON lines exports, file is read again on each iteration
+    """
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    def __iter__(self):
+        with open(self._filename) as f:
+            buffer = f.read(self.CHUNK_SIZE).lstrip()
+            if buffer.startswith('['):
+                yield from self._iter_array(f, buffer[1:])
+            else:
+                f.seek(0)
+                yield from self._iter_lines(f)
+
+    @staticmethod
+    def _iter_lines(f):
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    def _iter_array(self, f, buffer):
+        decoder = json.JSONDecoder()
+        eof = False
+        index = 0
+        while True:
+            # skip whitespace and commas between tasks
+            index = TASKS_SEPARATOR_RE.match(buffer, index).end()
+            if index == len(buffer):
+                if eof:
+                    raise ValueError(f'Unexpected end of tasks array in {self._filename}')
+                chunk = f.read(self.CHUNK_SIZE)
+                eof = not chunk
+                buffer, index = chunk, 0
+                continue
+            if buffer[index] == ']':
+                return
+            try:
+                task, index = decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # task is not fully loaded yet, read at least as much as already buffered
+                chunk = f.read(max(self.CHUNK_SIZE, len(buffer) - index))
+                eof = not chunk
+                buffer, index = buffer[index:] + chunk, 0
+                continue
+            yield task
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
 
 class Matcher:
     """
@@ -30,6 +109,8 @@ class Matcher:
         self._raw_data = {}
         self._project_url = url + f'/api/projects/{project}'
         self._control_weights = {}
+        self._plans = {}
+        self._plans_project = self._control_weights
         self._url = url
         self._project = project
 
@@ -58,9 +139,12 @@ class Matcher:
     def refresh(self):
         self._load_data()
 
-    def _load_from_file(self, filename):
-        with open(filename) as f:
-            self._raw_data = json.load(f)
+    def _load_from_file(self, filename, stream=False):
+        if stream:
+            self._raw_data = TasksStream(filename)
+        else:
+            with open(filename) as f:
+                self._raw_data = json.load(f)
         # check data for annotations tag
         for item in self._raw_data:
             if item.get('completions') is not None:
@@ -82,8 +166,13 @@ class Matcher:
                     result += 1
         return result
 
-    def load(self, filename):
-        self._load_from_file(filename)
+    def load(self, filename, stream=False):
+        """
+        Load tasks from Label Studio export file
+        :param filename: JSON or JSON lines export file
+        :param stream: Iterate tasks from file on demand instead of loading the whole file into memory
+        """
+        self._load_from_file(filename, stream=stream)
 
     def get_iou_score(self):
         """
@@ -103,105 +192,190 @@ class Matcher:
             agreement = None
         return agreement
 
-    def get_score_per_task(self, metric_name=None):
+    def _worker_copy(self):
+        """
+        Copy of matcher without loaded data to be sent to worker processes
+        """
+        matcher = copy(self)
+        matcher._raw_data = []
+        matcher._plans = {}
+        return matcher
+
+    def _dispatch_plan(self, per_label=False, metric_name=None, iou_threshold=None):
+        """
+        Dispatch plan for Metrics.apply_with_plan compiled once per project and metric params,
+        plans are compiled again after project is loaded again
+        """
+        if self._plans_project is not self._control_weights:
+            self._plans = {}
+            self._plans_project = self._control_weights
+        key = (per_label, metric_name, iou_threshold)
+        if key not in self._plans:
+            self._plans[key] = Metrics.compile(self._control_weights or {}, metric_name=metric_name,
+                                               per_label=per_label, iou_threshold=iou_threshold)
+        return self._plans[key]
+
+    def _map_tasks(self, method, tasks=None, workers=None, executor=None, chunksize=None, **kwargs):
+        """
+        Apply matcher method to each task from loaded data, results order is the same as tasks order,
+        exception raised for any task is raised the same way as in serial processing
+        :param method: Name of matcher method that takes task as the first argument
+        :param tasks: Iterable of tasks to process instead of all loaded data
+        :param workers: Number of worker processes, tasks are processed serially if not set and executor is not set
+        :param executor: concurrent.futures.Executor to use instead of creating process pool,
+        workers is the number of its workers then, its processes should register the same metrics,
+        e.g. by initializer=init_worker, initargs=(Metrics._metrics,)
+        :param chunksize: Number of tasks sent to worker at once
+        :param kwargs: Method keyword arguments
+        :return: list of method results
+        """
+        if tasks is None:
+            tasks = self._raw_data
+        if not workers and executor is None:
+            func = partial(getattr(self, method), **kwargs)
+            return [func(task) for task in tasks]
+        # bind method to matcher copy to avoid sending all loaded data with each chunk
+        func = partial(getattr(self._worker_copy(), method), **kwargs)
+        num_workers = workers or 1
+        if chunksize is None:
+            if isinstance(self._raw_data, list):
+                chunksize = max(1, len(self._raw_data) // (num_workers * 4))
+            else:
+                chunksize = 16
+        if executor is not None:
+            return self._map_batches(executor, func, tasks, chunksize, num_workers)
+        # metrics registered at runtime are sent to workers started without fork
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(Metrics._metrics,)) as pool:
+            return self._map_batches(pool, func, tasks, chunksize, num_workers)
+
+    @staticmethod
+    def _map_batches(executor, func, tasks, chunksize, num_workers):
+        # submit tasks by batches to keep streamed data bounded in memory
+        results = []
+        for batch in _batches(tasks, chunksize * num_workers * 4):
+            results.extend(executor.map(func, batch, chunksize=chunksize))
+        return results
+
+    def get_score_per_task(self, metric_name=None, workers=None, executor=None, chunksize=None):
         """
         One evaluation score per N predictions vs all annotations
+        :param workers: Number of worker processes to shard tasks across (number of executor workers if set)
+        :param executor: concurrent.futures.Executor to shard tasks across
+        :param chunksize: Number of tasks sent to worker at once
         :return: agreement float[0..1] or None
         """
-        agreement = []
+        return self._map_tasks('_task_score', metric_name=metric_name,
+                               workers=workers, executor=executor, chunksize=chunksize)
 
-        for item in self._raw_data:
-            annotations = item[self._result_name]
-            predictions = item['predictions']
-            score = self.matching_score(annotations, predictions, metric_name=metric_name)
-            agreement.append(score)
-        return agreement
+    def _task_score(self, item, metric_name=None):
+        annotations = item[self._result_name]
+        predictions = item['predictions']
+        return self.matching_score(annotations, predictions, metric_name=metric_name)
 
-    def get_score_per_prediction(self, per_label=False, metric_name=None):
+    def get_score_per_prediction(self, per_label=False, metric_name=None, workers=None, executor=None,
+                                 chunksize=None):
         """
         N agreement scores per each prediction vs corresponding annotation
+        :param workers: Number of worker processes to shard tasks across (number of executor workers if set)
+        :param executor: concurrent.futures.Executor to shard tasks across
+        :param chunksize: Number of tasks sent to worker at once
         :return: dict  {
                         prediction.id: float[0..1]
                         }
         """
         scores = {}
-        control_weights = self._control_weights or {}
-        for item in self._raw_data:
-            annotations = item[self._result_name]
-            predictions = item.get('predictions')
-            if predictions is None:
-                logger.warning('No predictions found in results.')
-                break
-            for prediction in predictions:
-                if per_label:
-                    scores[prediction['id']] = defaultdict(int)
-                    score = defaultdict(int)
-                    tasks = defaultdict(int)
-                else:
-                    scores[prediction['id']] = None
-                    score = 0
-                    tasks = 0
-                for annotation in annotations:
-                    try:
-                        prediction_result = prediction['result'] if self._new_format else prediction['result'][0]
-                        annotation_result = annotation['result'] if self._new_format else annotation['result'][0]
-                        matching = Metrics.apply(
-                            control_weights, prediction_result, annotation_result,
-                            symmetric=True, per_label=per_label, metric_name=metric_name
-                        )
-                        if per_label:
-                            for label in matching:
-                                score[label] += matching[label]
-                                tasks[label] += 1
-                        else:
-                            score += matching
-                            tasks += 1
-                    except Exception as exc:
-                        logger.debug(
-                            f"Can\'t compute matching score in similarity matrix for task=,"
-                            f"annotation={annotation}, prediction={prediction}, "
-                            f"Reason: {exc}",
-                            exc_info=True,
-                        )
-                if per_label:
-                    for label in tasks:
-                        scores[prediction['id']][label] = score[label] / tasks[label]
-                else:
-                    if tasks > 0:
-                        scores[prediction['id']] = score / tasks
+        # tasks are scored only up to the first task without predictions
+        tasks = takewhile(self._has_predictions, self._raw_data)
+        tasks_scores = self._map_tasks('_task_score_per_prediction', tasks, per_label=per_label,
+                                       metric_name=metric_name, workers=workers, executor=executor,
+                                       chunksize=chunksize)
+        for task_scores in tasks_scores:
+            scores.update(task_scores)
         return scores
 
-    def agreement_matrix(self, per_label=False, metric_name=None):
+    @staticmethod
+    def _has_predictions(item):
+        if item.get('predictions') is None:
+            logger.warning('No predictions found in results.')
+            return False
+        return True
+
+    def _task_score_per_prediction(self, item, per_label=False, metric_name=None):
+        scores = {}
+        plan = self._dispatch_plan(per_label=per_label, metric_name=metric_name)
+        annotations = item[self._result_name]
+        predictions = item['predictions']
+        for prediction in predictions:
+            if per_label:
+                scores[prediction['id']] = defaultdict(int)
+                score = defaultdict(int)
+                tasks = defaultdict(int)
+            else:
+                scores[prediction['id']] = None
+                score = 0
+                tasks = 0
+            for annotation in annotations:
+                try:
+                    prediction_result = prediction['result'] if self._new_format else prediction['result'][0]
+                    annotation_result = annotation['result'] if self._new_format else annotation['result'][0]
+                    matching = Metrics.apply_with_plan(plan, prediction_result, annotation_result, symmetric=True)
+                    if per_label:
+                        for label in matching:
+                            score[label] += matching[label]
+                            tasks[label] += 1
+                    else:
+                        score += matching
+                        tasks += 1
+                except Exception as exc:
+                    logger.debug(
+                        f"Can\'t compute matching score in similarity matrix for task=,"
+                        f"annotation={annotation}, prediction={prediction}, "
+                        f"Reason: {exc}",
+                        exc_info=True,
+                    )
+            if per_label:
+                for label in tasks:
+                    scores[prediction['id']][label] = score[label] / tasks[label]
+            else:
+                if tasks > 0:
+                    scores[prediction['id']] = score / tasks
+        return scores
+
+    def agreement_matrix(self, per_label=False, metric_name=None, workers=None, executor=None, chunksize=None):
         """
         Per task agreement matrix for annotations
+        :param workers: Number of worker processes to shard tasks across (number of executor workers if set)
+        :param executor: concurrent.futures.Executor to shard tasks across
+        :param chunksize: Number of tasks sent to worker at once
         :return: { task.id: np.array(m, m) -> float[0..1]
         }
         """
         agreement = {}
-        control_weights = self._control_weights or {}
-        for item in self._raw_data:
-            annotations = item[self._result_name]
-            if len(annotations) > 0:
-                num_results = len(annotations) if self._new_format else len(annotations[0]['result'])
-            else:
-                continue
-            matrix = np.full((num_results, num_results), np.nan)
-            for i in range(num_results):
-                for j in range(i + 1, num_results):
-                    annotations_i = annotations[i]['result'] if self._new_format else annotations[0]['result'][i]
-                    annotations_j = annotations[j]['result'] if self._new_format else annotations[0]['result'][j]
-                    matching_score = Metrics.apply(
-                        control_weights,
-                        annotations_i,
-                        annotations_j,
-                        symmetric=True,
-                        per_label=per_label,
-                        metric_name=metric_name,
-                    )
-                    matrix[i][j] = matrix[j][i] = matching_score
-            agreement[item['id']] = matrix
+        tasks_matrices = self._map_tasks('_task_agreement_matrix', per_label=per_label, metric_name=metric_name,
+                                         workers=workers, executor=executor, chunksize=chunksize)
+        for task_matrix in tasks_matrices:
+            if task_matrix is not None:
+                task_id, matrix = task_matrix
+                agreement[task_id] = matrix
         return agreement
 
+    def _task_agreement_matrix(self, item, per_label=False, metric_name=None):
+        plan = self._dispatch_plan(per_label=per_label, metric_name=metric_name)
+        annotations = item[self._result_name]
+        if len(annotations) > 0:
+            num_results = len(annotations) if self._new_format else len(annotations[0]['result'])
+        else:
+            return None
+        matrix = np.full((num_results, num_results), np.nan)
+        for i in range(num_results):
+            for j in range(i + 1, num_results):
+                annotations_i = annotations[i]['result'] if self._new_format else annotations[0]['result'][i]
+                annotations_j = annotations[j]['result'] if self._new_format else annotations[0]['result'][j]
+                matching_score = Metrics.apply_with_plan(plan, annotations_i, annotations_j, symmetric=True)
+                matrix[i][j] = matrix[j][i] = matching_score
+        return item['id'], matrix
+
     def matching_score(self, annotations, predictions, metric_name=None, iou_threshold=None):
         """
         One evaluation score per N predictions vs all annotations per task
@@ -209,16 +383,13 @@ class Matcher:
         """
         score = 0
         tasks = 0
-        control_weights = self._control_weights or {}
+        plan = self._dispatch_plan(metric_name=metric_name, iou_threshold=iou_threshold)
         for annotation in annotations:
             for prediction in predictions:
                 try:
                     prediction_result = prediction['result'] if self._new_format else prediction['result'][0]
                     annotation_result = annotation['result'] if self._new_format else annotation['result'][0]
-                    matching = Metrics.apply(
-                        control_weights, prediction_result, annotation_result, symmetric=True, per_label=False,
-                        metric_name=metric_name, iou_threshold=iou_threshold
-                    )
+                    matching = Metrics.apply_with_plan(plan, prediction_result, annotation_result, symmetric=True)
                     score += matching
                     tasks += 1
                 except Exception as exc:
@@ -240,16 +411,13 @@ class Matcher:
         """
         score = defaultdict(int)
         tasks = defaultdict(int)
-        control_weights = self._control_weights or {}
+        plan = self._dispatch_plan(per_label=True, metric_name=metric_name, iou_threshold=iou_threshold)
         for annotation in annotations:
             for prediction in predictions:
                 try:
                     prediction_result = prediction['result'] if self._new_format else prediction['result'][0]
                     annotation_result = annotation['result'] if self._new_format else annotation['result'][0]
-                    matching = Metrics.apply(
-                        control_weights, prediction_result, annotation_result, symmetric=True, per_label=True,
-                        metric_name=metric_name, iou_threshold=iou_threshold
-                    )
+                    matching = Metrics.apply_with_plan(plan, prediction_result, annotation_result, symmetric=True)
                     for label in matching:
                         score[label] += matching[label]
                         tasks[label] += 1
@@ -320,16 +488,19 @@ class Matcher:
                     )
         return results
 
-    def get_annotations_agreement(self, metric_name=None):
+    def get_annotations_agreement(self, metric_name=None, workers=None, executor=None, chunksize=None):
         """
         One evaluation score per all annotations
+        :param workers: Number of worker processes to shard tasks across (number of executor workers if set)
+        :param executor: concurrent.futures.Executor to shard tasks across
+        :param chunksize: Number of tasks sent to worker at once
         :return: agreement float[0..1] or None
         """
         score = 0
         tasks = 0
-        for item in self._raw_data:
-            annotations = item[self._result_name]
-            s = self.matching_score(annotations, annotations, metric_name=metric_name)
+        tasks_scores = self._map_tasks('_task_annotations_agreement', metric_name=metric_name,
+                                       workers=workers, executor=executor, chunksize=chunksize)
+        for s in tasks_scores:
             score += s if s else 0
             tasks += 1
         if tasks > 0:
@@ -337,3 +508,7 @@ class Matcher:
         else:
             agreement = None
         return agreement
+
+    def _task_annotations_agreement(self, item, metric_name=None):
+        annotations = item[self._result_name]
+        return self.matching_score(annotations, annotations, metric_name=metric_name)
@@ -5,7 +5,6 @@ import attr
 
 from scipy.cluster.hierarchy import single, complete, fcluster
 from scipy.spatial.distance import squareform
-from itertools import chain
 from collections import defaultdict
 from copy import deepcopy
 
@@ -24,6 +23,15 @@ class MetricWrapper(object):
     tag = attr.ib()
     is_default = attr.ib(default=True)
     tags = attr.ib(default=[])
+    symmetric = attr.ib(default=False)
+
+
+@attr.s
+class ControlDispatch(object):
+    matching_func = attr.ib()
+    overall_weight = attr.ib()
+    params = attr.ib()
+    symmetric = attr.ib(default=False)
 
 
 class Metrics(object):
@@ -37,8 +45,20 @@ class Metrics(object):
         return tag.lower()
 
     @classmethod
-    def register(cls, name, form, tag, func, desc, is_default=True, tags=None):
-        cls._metrics[name] = MetricWrapper(name, form, desc, func, cls._norm_tag(tag), is_default, tags)
+    def register(cls, name, form, tag, func, desc, is_default=True, tags=None, symmetric=False):
+        """
+        Register matching function
+        :param name: Metric name
+        :param form: Form name for metric params
+        :param tag: Control tag name
+        :param func: Matching function func(results_first, results_second, **params)
+        :param desc: Metric description
+        :param is_default: Use metric by default for the tag
+        :param tags: List of tags
+        :param symmetric: func(a, b) == func(b, a), so symmetric score is computed with a single call,
+        function of matching function params returning bool if it depends on them
+        """
+        cls._metrics[name] = MetricWrapper(name, form, desc, func, cls._norm_tag(tag), is_default, tags, symmetric)
 
     @classmethod
     def get_schema(cls, tag):
@@ -74,6 +94,17 @@ class Metrics(object):
     def filter_results_by_from_name(cls, results, from_name):
         return list(filter(lambda r: r.get('from_name') == from_name, results))
 
+    @classmethod
+    def partition_results_by_from_name(cls, results):
+        """
+        Group results by from_name once to reuse them across many comparisons
+        :param results: completion.result
+        :return: ResultsPartition object
+        """
+        if isinstance(results, ResultsPartition):
+            return results
+        return ResultsPartition(results)
+
     @classmethod
     def get_type(cls, result):
         t = result.get('type')
@@ -87,6 +118,23 @@ class Metrics(object):
                 t += '[per_region=poly]'
         return t
 
+    @classmethod
+    def compile(cls, project, metric_name=None, per_label=False, iou_threshold=None, feature_flags=None):
+        """
+        Build dispatch plan for repeated Metrics.apply calls within the same project
+        :param project: Project object used for getting matching score function parameters
+        :param metric_name: name of metric to use
+        :param per_label: per_label calculation or overall
+        :param iou_threshold: intersection over union threshold
+        :param feature_flags: feature flags passed to matching functions
+        :return: DispatchPlan object
+        """
+        return DispatchPlan(project,
+                            metric_name=metric_name,
+                            per_label=per_label,
+                            iou_threshold=iou_threshold,
+                            feature_flags=feature_flags)
+
     @classmethod
     def apply(cls, project, result_first, result_second, symmetric=True, per_label=False,
               metric_name=None, iou_threshold=None, **kwargs):
@@ -103,6 +151,33 @@ class Metrics(object):
         Returns:
             Matching score averaged over all different "from_name"s with corresponding weights taken from project.control_weights  # noqa
         """
+        plan = cls.compile(project,
+                           metric_name=metric_name,
+                           per_label=per_label,
+                           iou_threshold=iou_threshold,
+                           feature_flags=kwargs.get('feature_flags'))
+        return cls.apply_with_plan(plan, result_first, result_second, symmetric=symmetric)
+
+    @classmethod
+    def apply_with_plan(cls, plan, result_first, result_second, symmetric=True):
+        """
+        Compute matching score between first and second completion results using precompiled plan
+        Args:
+        :param plan: DispatchPlan object from Metrics.compile()
+        :param result_first: first completion.result or its ResultsPartition
+        :param result_second: second completion.result or its ResultsPartition
+        :param symmetric: symmetric result doesn't depend on the first/second results order
+        Returns:
+            Matching score averaged over all different "from_name"s with corresponding weights taken from project.control_weights  # noqa
+        """
+        project = plan.project
+        per_label = plan.per_label
+        # results could be already partitioned by from_name
+        partition_first = partition_second = None
+        if isinstance(result_first, ResultsPartition):
+            partition_first, result_first = result_first, result_first.results
+        if isinstance(result_second, ResultsPartition):
+            partition_second, result_second = result_second, result_second.results
         # decide which object to use annotation-based or result-based
         if isinstance(result_first, dict) and isinstance(result_second, dict):
             annotations_or_result = True
@@ -116,95 +191,51 @@ class Metrics(object):
                 return {}
             return float(type(result_first) == type(result_second))
 
-        # collect mapping between control tag name and control type
-        all_controls = {}
-        for r in chain(result_first, result_second):
-            if 'from_name' not in r:
-                # we skip all non-control tag results like relations, etc.
-                continue
-            all_controls[r['from_name']] = cls.get_type(r)
-
-        def get_matching_func(control_type, name=None):
-            if name:
-                return cls.get_default_metric_for_name_tag(control_type, name)
-            else:
-                return cls.get_default_metric_for_tag(control_type)
-
-        def get_matching_func_annotation(name=None):
-            return cls.get_default_metric_for_name_tag('all', name)
-
         def symmetrize(a, b):
             if a is None:
                 return b
             if b is None:
                 return a
             return min(a, b)
-        # get metric params
-        params = project.get("metric_params", {})
+
         if per_label:
             score, n = defaultdict(int), defaultdict(int)
         else:
             score, n = 0, 0
 
         if annotations_or_result:
-            # remove backup parameters
-            list(map(params.pop,
-                     [item for item in params if item.startswith("__") and item not in cls.IGNORE_BACKUP_PARAMS]))
             # get matching score over annotations as a hole
-            if project == {}:
-                control_params = {}
-            else:
-                control_weights = project.get("control_weights", {})
-                control_params = deepcopy(params)
-                control_params['control_weights'] = control_weights
-                control_params['per_label'] = per_label
-
-            matching_func = get_matching_func_annotation(name=metric_name)
+            matching_func, control_params = plan.get_annotation_dispatch()
             if per_label:
                 score, n = matching_func.func(result_first, result_second, **control_params)
             else:
                 score = matching_func.func(result_first, result_second, **control_params)
                 n = 1
         else:
-            # remove backup parameters
-            list(map(params.pop,
-                     [item for item in params if item.startswith("__")]))
+            # group results by control tag name once for all controls
+            partition_first = partition_first or cls.partition_results_by_from_name(result_first)
+            partition_second = partition_second or cls.partition_results_by_from_name(result_second)
+            # collect mapping between control tag name and control type
+            all_controls = dict(partition_first.controls)
+            all_controls.update(partition_second.controls)
+
             # aggregate matching scores over all existed controls
             for control_name, control_type in all_controls.items():
                 logger.debug(f"Starting calculation for {control_type} - {control_name}")
-                matching_func = get_matching_func(control_type, metric_name)
-                if not matching_func:
-                    logger.error(f'No matching function found for control type >>{control_type} in project.id >>{project.get("id")}.')
-                    continue
-                # construct params for function
-                control_weights = project.get("control_weights", {})
-                control_weights = control_weights.get(control_name, {})
-                overall_weight = control_weights.get('overall', 1)
-                if overall_weight == 0:
-                    logger.debug(f'Overall weight for control type >>{control_type} is 0.')
+                dispatch = plan.get_control_dispatch(control_name, control_type)
+                if dispatch is None or dispatch.overall_weight == 0:
                     continue
-                label_weights = control_weights.get('labels')
-                control_params = deepcopy(params)
-                control_params['label_weights'] = label_weights
-                control_params['per_label'] = per_label
-                if iou_threshold:
-                    control_params['iou_threshold'] = iou_threshold
-                # identify if label config need
-                func_args = inspect.getfullargspec(matching_func.func)
-                if 'label_config' in func_args[0]:
-                    control_params['label_config'] = project.get("label_config")
-                if 'control_name' in func_args[0]:
-                    control_params['control_name'] = control_name
-
-                feature_flags = kwargs.get('feature_flags')
-                if feature_flags:
-                    control_params.update(feature_flags)
+                matching_func = dispatch.matching_func
+                control_params = dispatch.params
+                overall_weight = dispatch.overall_weight
 
                 # get result of certain control_name
-                results_first_by_from_name = cls.filter_results_by_from_name(result_first, control_name)
-                results_second_by_from_name = cls.filter_results_by_from_name(result_second, control_name)
+                results_first_by_from_name = partition_first.get(control_name)
+                results_second_by_from_name = partition_second.get(control_name)
                 s = matching_func.func(results_first_by_from_name, results_second_by_from_name, **control_params)
-                if symmetric:
+                # symmetric metrics give the same overall score in both directions,
+                # but per label scores are still keyed by labels of the first argument
+                if symmetric and (per_label or not dispatch.symmetric):
                     # get symmetric score
                     s_reversed = matching_func.func(results_second_by_from_name, results_first_by_from_name,
                                                     **control_params)
@@ -222,7 +253,7 @@ class Metrics(object):
                     score += s * overall_weight
                     n += overall_weight
                 logger.debug(f"Ending calculation for {control_type} - {control_name}")
-                
+
         def clipped(s):
             if s > 1 or s < 0:
                 logger.debug('Error in project %s. Matching score %s is not within [0, 1] interval '
@@ -242,6 +273,25 @@ class Metrics(object):
 
         return clipped(score / float(n) if n > 0 else 0)
 
+    @classmethod
+    def similarity_matrix(cls, project, results, metric_name=None, **kwargs):
+        """
+        Compute pairwise symmetric matching scores between all results at once
+        Dispatch plan and results partitions are built once for all pairs
+        :param project: Project object used for getting matching score function parameters
+        :param results: list of results
+        :param metric_name: name of metric to use
+        :return: np.array(n, n) with zero diagonal
+        """
+        num_results = len(results)
+        result_sim = np.zeros((num_results, num_results), dtype=np.float64)
+        plan = cls.compile(project, metric_name=metric_name, feature_flags=kwargs.get('feature_flags'))
+        results = [cls.partition_results_by_from_name(r) if isinstance(r, list) else r for r in results]
+        for i in range(num_results):
+            for j in range(i + 1, num_results):
+                result_sim[i, j] = cls.apply_with_plan(plan, results[i], results[j], symmetric=True)
+        return result_sim + result_sim.T
+
     @classmethod
     def average(cls, project, results):
         n = len(results)
@@ -249,10 +299,8 @@ class Metrics(object):
             return 0.0
         if n == 1:
             return 1.0
-        mean_score = 0
-        for i in range(n):
-            for j in range(i + 1, n):
-                mean_score += Metrics.apply(project, results[i], results[j], symmetric=True)
+        result_sim = cls.similarity_matrix(project, results)
+        mean_score = float(sum(result_sim[np.triu_indices(n, k=1)]))
         norm = n * (n - 1) / 2
         return mean_score / max(norm, 1)
 
@@ -271,11 +319,7 @@ class Metrics(object):
             raise ValueError(f'Can\'t group empty results for project {project}')
         if num_results == 1:
             return {0: [0]}
-        result_sim = np.zeros((num_results, num_results), dtype=np.float64)
-        for i in range(num_results):
-            for j in range(i + 1, num_results):
-                result_sim[i, j] = Metrics.apply(project, results[i], results[j], symmetric=True)
-        result_sim = result_sim + result_sim.T
+        result_sim = cls.similarity_matrix(project, results)
         margin = 1.01 * np.max(result_sim)
         dists = margin - squareform(result_sim)
         if project.agreement_method == project.SINGLE or not project.agreement_method:
@@ -294,6 +338,116 @@ class Metrics(object):
         return groups
 
 
+class ResultsPartition(object):
+    """
+    Results grouped by control tag name (from_name)
+    """
+
+    def __init__(self, results):
+        self.results = results
+        # mapping between control tag name and control type
+        self.controls = {}
+        self._by_from_name = defaultdict(list)
+        for r in results:
+            self._by_from_name[r.get('from_name')].append(r)
+            if 'from_name' not in r:
+                # we skip all non-control tag results like relations, etc.
+                continue
+            self.controls[r['from_name']] = Metrics.get_type(r)
+
+    def get(self, from_name):
+        return self._by_from_name.get(from_name, [])
+
+    def __len__(self):
+        return len(self.results)
+
+
+class DispatchPlan(object):
+    """
+    Precompiled dispatch for Metrics.apply_with_plan()
+
+    Keeps resolved matching functions, control weights and matching function params for
+    each (control name, control type) pair, so they are built once per project and metric name
+    instead of once per compared pair of results.
+    Plan should be rebuilt after project parameters or registered metrics are changed.
+    """
+
+    def __init__(self, project, metric_name=None, per_label=False, iou_threshold=None, feature_flags=None):
+        self.project = project
+        self.metric_name = metric_name
+        self.per_label = per_label
+        self.iou_threshold = iou_threshold
+        self.feature_flags = feature_flags
+        self._controls = {}
+        self._annotation_dispatch = None
+        # get metric params without backup parameters
+        self._params = {k: v for k, v in project.get("metric_params", {}).items() if not k.startswith("__")}
+
+    def get_annotation_dispatch(self):
+        """
+        Get matching function and params to compare annotations as a whole
+        :return: tuple(MetricWrapper, dict)
+        """
+        if self._annotation_dispatch is None:
+            if self.project == {}:
+                control_params = {}
+            else:
+                params = self.project.get("metric_params", {})
+                control_params = {k: deepcopy(v) for k, v in params.items()
+                                  if not k.startswith("__") or k in Metrics.IGNORE_BACKUP_PARAMS}
+                control_params['control_weights'] = self.project.get("control_weights", {})
+                control_params['per_label'] = self.per_label
+            matching_func = Metrics.get_default_metric_for_name_tag('all', self.metric_name)
+            self._annotation_dispatch = (matching_func, control_params)
+        return self._annotation_dispatch
+
+    def get_control_dispatch(self, control_name, control_type):
+        """
+        Get matching function, overall weight and params for control
+        :param control_name: Control tag name (from_name)
+        :param control_type: Control type from Metrics.get_type()
+        :return: ControlDispatch or None if there is no matching function for control
+        """
+        key = (control_name, control_type)
+        if key not in self._controls:
+            self._controls[key] = self._build_control_dispatch(control_name, control_type)
+        return self._controls[key]
+
+    def _build_control_dispatch(self, control_name, control_type):
+        if self.metric_name:
+            matching_func = Metrics.get_default_metric_for_name_tag(control_type, self.metric_name)
+        else:
+            matching_func = Metrics.get_default_metric_for_tag(control_type)
+        if not matching_func:
+            logger.error(f'No matching function found for control type >>{control_type} '
+                         f'in project.id >>{self.project.get("id")}.')
+            return None
+        # construct params for function
+        control_weights = self.project.get("control_weights", {})
+        control_weights = control_weights.get(control_name, {})
+        overall_weight = control_weights.get('overall', 1)
+        if overall_weight == 0:
+            logger.debug(f'Overall weight for control type >>{control_type} is 0.')
+            return ControlDispatch(matching_func, overall_weight, {})
+        control_params = deepcopy(self._params)
+        control_params['label_weights'] = control_weights.get('labels')
+        control_params['per_label'] = self.per_label
+        if self.iou_threshold:
+            control_params['iou_threshold'] = self.iou_threshold
+        # identify if label config need
+        func_args = inspect.getfullargspec(matching_func.func)
+        if 'label_config' in func_args[0]:
+            control_params['label_config'] = self.project.get("label_config")
+        if 'control_name' in func_args[0]:
+            control_params['control_name'] = control_name
+        if self.feature_flags:
+            control_params.update(self.feature_flags)
+        symmetric = matching_func.symmetric
+        if callable(symmetric):
+            symmetric = symmetric(**control_params)
+        return ControlDispatch(matching_func, overall_weight, control_params, symmetric)
+
+
 Metrics.register(
     name='naive',
     form='empty_form',
@@ -1,4 +1,5 @@
-from evalme.text.text import datetime_match, numbers_match, intersection_text_tagging, intersection_textarea_tagging, match_textareas, intersection_text_tagging
+from evalme.text.text import datetime_match, numbers_match, intersection_text_tagging, intersection_textarea_tagging, match_textareas, intersection_text_tagging, \
+    textareas_symmetric
 from evalme.classification import ClassificationEvalItem, ChoicesEvalItem, naive, exact_matching_choices
 from evalme.metrics import Metrics
 from evalme.image.object_detection import iou_polygons, iou_bboxes_textarea, iou_polygons_textarea, iou_bboxes
@@ -86,7 +87,8 @@ Metrics.register(
     form='edit_distance',
     tag='TextArea',
     func=match_textareas,
-    desc='Text edit distance'
+    desc='Text edit distance',
+    symmetric=textareas_symmetric
 )
 
 Metrics.register(
@@ -0,0 +1,91 @@
+import numpy as np
+
+from evalme.image.brush import decode_rle, decode_rle_bit_string, decode_rle_runs, encode_rle, decoded_runs_cache
+from evalme.image.object_detection import BrushEvalItem, iou_brush
+
+
+def test_decode_rle():
+    """
+    Decoded brush mask is the same as decoded from bit string
+    """
+    mask = np.zeros((60, 80, 4), dtype=np.uint8)
+    mask[10:30, 20:50] = 255
+    mask[40, ::3] = 7
+    mask[45:50, 5:9, 1] = np.arange(20, dtype=np.uint8).reshape(5, 4)
+    rle = encode_rle(mask)
+    decoded = decode_rle(rle)
+    assert decoded.dtype == np.uint8
+    assert decoded.tobytes() == mask.tobytes()
+    assert decoded.tobytes() == decode_rle_bit_string(rle).tobytes()
+
+
+def test_decode_rle_empty():
+    assert len(decode_rle(encode_rle(np.zeros(0, dtype=np.uint8)))) == 0
+
+
+def test_decode_rle_runs_iou():
+    """
+    IOU on runs of nonzero values is the same as IOU on decoded masks
+    """
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        masks = []
+        for _ in range(2):
+            mask = np.zeros((30, 40, 4), dtype=np.uint8)
+            for _ in range(5):
+                y, x = rng.integers(0, 30), rng.integers(0, 40)
+                mask[y:y + rng.integers(1, 10), x:x + rng.integers(1, 10)] = 255
+            # single values are encoded as literal runs
+            mask.ravel()[rng.integers(0, mask.size, 30)] = rng.integers(0, 256, 30)
+            masks.append(mask)
+        runs = [decode_rle_runs(encode_rle(mask)) for mask in masks]
+        assert runs[0].area == np.count_nonzero(masks[0])
+        union = np.logical_or(*masks).sum()
+        intersection = np.logical_and(*masks).sum()
+        assert runs[0].intersection(runs[1]) == intersection
+        assert runs[0].iou(runs[1]) == intersection / max(union, 1)
+        # bounding boxes prefilter doesn't change the result
+        assert runs[0].iou(runs[1], row_size=40 * 4) == intersection / max(union, 1)
+
+
+def test_decode_rle_runs_bbox():
+    mask = np.zeros((30, 40, 4), dtype=np.uint8)
+    mask[5:10, 2:4] = 255
+    other = np.zeros((30, 40, 4), dtype=np.uint8)
+    other[5:10, 20:30] = 255
+    runs, other_runs = decode_rle_runs(encode_rle(mask)), decode_rle_runs(encode_rle(other))
+    assert runs.bbox(40 * 4) == (5, 9, 2 * 4, 4 * 4 - 1)
+    # runs extents overlap but masks are in different columns
+    assert runs.bbox_overlaps(other_runs)
+    assert not runs.bbox_overlaps(other_runs, 40 * 4)
+    assert runs.iou(other_runs, 40 * 4) == 0
+
+
+def _brush(mask, label):
+    return {"value": {"format": "rle", "rle": encode_rle(mask), "brushlabels": [label]}}
+
+
+def test_brush_iou_decoded_runs_cache():
+    """
+    Each brush mask is decoded once per item and once per process with enabled cache
+    """
+    first = np.zeros((20, 20, 4), dtype=np.uint8)
+    first[:10] = 255
+    second = np.zeros((20, 20, 4), dtype=np.uint8)
+    second[5:10] = 255
+    gt = [_brush(first, "Car"), _brush(second, "Car")]
+    pred = [_brush(second, "Car"), _brush(first, "Car"), _brush(first, "Airplane")]
+    decoded_runs_cache.clear()
+    decoded_runs_cache.resize(1 << 20)
+    try:
+        assert iou_brush(gt, pred, label_weights={}) == 1
+        assert iou_brush(gt, pred, per_label=True) == {"Car": 1}
+        assert BrushEvalItem._iou(gt[0]["value"], gt[1]["value"]) == 0.5
+        # 2 unique masks were decoded
+        assert decoded_runs_cache.misses == 2
+        assert decoded_runs_cache.hits > 0
+        decoded_runs_cache.resize(decode_rle_runs(encode_rle(first)).nbytes)
+        assert len(decoded_runs_cache._masks) == 1
+    finally:
+        decoded_runs_cache.resize(0)
+        decoded_runs_cache.clear()
@@ -1,6 +1,22 @@
-from evalme.matcher import Matcher
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
-from evalme.metrics import get_agreement
+import numpy as np
+import pytest
+
+from evalme.matcher import Matcher, TasksStream
+
+from evalme.metrics import Metrics, get_agreement
+
+
+def constant_match(x, y, **kwargs):
+    return 0.25
+
+
+def failing_match(x, y, **kwargs):
+    raise ValueError('failing metric')
 
 
 def test_agreement_matrix():
@@ -58,4 +74,115 @@ def test_get_agreement_per_label():
     t1 = get_agreement(item_old, item_new, per_label=True)
     assert t1[1] == {}
     t2 = get_agreement(item_new, item_old, per_label=True)
-    assert t2[1] == {}
\ No newline at end of file
+    assert t2[1] == {}
+
+
+def test_agreement_matrix_workers():
+    """
+    Test project-wide scoring sharded across worker processes gives the same results
+    """
+    m = Matcher()
+    m.load(r"./tests/test_data/test_bbox.json")
+
+    matrix = m.agreement_matrix()
+    matrix_workers = m.agreement_matrix(workers=2)
+    assert matrix.keys() == matrix_workers.keys()
+    for task_id in matrix:
+        np.testing.assert_array_equal(matrix[task_id], matrix_workers[task_id])
+    assert m.get_annotations_agreement() == m.get_annotations_agreement(workers=2, chunksize=1)
+    assert m.get_score_per_task() == m.get_score_per_task(workers=2)
+
+
+def test_load_stream(tmp_path, monkeypatch):
+    """
+    Test streaming load of JSON array and JSON lines exports
+    """
+    m = Matcher()
+    m.load(r"./tests/test_data/test_bbox.json")
+    m_stream = Matcher()
+    # small chunks to check tasks split between reads
+    monkeypatch.setattr(TasksStream, 'CHUNK_SIZE', 7)
+    m_stream.load(r"./tests/test_data/test_bbox.json", stream=True)
+    assert list(m_stream._raw_data) == m._raw_data
+    assert m_stream._result_name == m._result_name
+    assert m_stream.get_annotations_agreement() == m.get_annotations_agreement()
+
+    filename = tmp_path / 'export.jsonl'
+    filename.write_text('\n'.join(json.dumps(task) for task in m._raw_data) + '\n')
+    m_lines = Matcher()
+    m_lines.load(str(filename), stream=True)
+    assert list(m_lines._raw_data) == m._raw_data
+    assert m_lines.get_score_per_task(workers=2) == m.get_score_per_task()
+
+
+def test_score_per_prediction_stops_without_predictions(monkeypatch):
+    """
+    Test tasks after the first task without predictions are not scored
+    """
+    m = Matcher()
+    m.load(r"./tests/test_data/test_bbox.json")
+    task = m._raw_data[0]
+    m._raw_data = [task, {key: value for key, value in task.items() if key != 'predictions'}, task]
+    scored = []
+    task_score = Matcher._task_score_per_prediction
+    monkeypatch.setattr(Matcher, '_task_score_per_prediction',
+                        lambda self, item, **kwargs: scored.append(item) or task_score(self, item, **kwargs))
+    scores = m.get_score_per_prediction()
+    assert len(scored) == 1
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert m.get_score_per_prediction(workers=2, executor=executor) == scores
+    assert len(scored) == 2
+
+
+def test_workers_runtime_metric_spawn(monkeypatch):
+    """
+    Test metrics registered at runtime are used by workers started by spawn
+    """
+    # test metrics are registered into the copy of registry
+    monkeypatch.setattr(Metrics, '_metrics', dict(Metrics._metrics))
+    Metrics.register(name='constant_test', form='', tag='all', func=constant_match, desc='constant')
+    monkeypatch.setattr('evalme.matcher.ProcessPoolExecutor',
+                        partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('spawn')))
+    m = Matcher()
+    m.load(r"./tests/test_data/test_bbox.json")
+    scores = m.get_score_per_task(metric_name='constant_test')
+    assert scores == [0.25] * len(m._raw_data)
+    assert m.get_score_per_task(metric_name='constant_test', workers=2) == scores
+
+
+def test_workers_raise_task_errors(monkeypatch):
+    """
+    Test exception raised for a task is raised the same way in serial and parallel processing
+    """
+    monkeypatch.setattr(Metrics, '_metrics', dict(Metrics._metrics))
+    Metrics.register(name='failing_test', form='', tag='all', func=failing_match, desc='failing')
+    m = Matcher()
+    m.load(r"./tests/test_data/test_bbox.json")
+    with pytest.raises(ValueError):
+        m.agreement_matrix(metric_name='failing_test')
+    with pytest.raises(ValueError):
+        m.agreement_matrix(metric_name='failing_test', workers=2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(ValueError):
+            m.agreement_matrix(metric_name='failing_test', workers=2, executor=executor)
+
+
+def test_dispatch_plan_compiled_once(monkeypatch):
+    """
+    Test dispatch plan is compiled once per metric params and again after project is loaded
+    """
+    compiled = []
+    compile_plan = Metrics.compile
+    monkeypatch.setattr(Metrics, 'compile',
+                        lambda *args, **kwargs: compiled.append(kwargs) or compile_plan(*args, **kwargs))
+    m = Matcher()
+    m.load(r"./tests/test_data/test_bbox.json")
+    agreement = m.get_annotations_agreement()
+    m.agreement_matrix()
+    assert len(compiled) == 1
+    m.get_score_per_prediction(per_label=True)
+    m.get_score_per_prediction(per_label=True)
+    assert len(compiled) == 2
+    m._control_weights = {"control_weights": {"label": {"overall": 0}}}
+    assert m.get_annotations_agreement() != agreement
+    assert len(compiled) == 3
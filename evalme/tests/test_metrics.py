@@ -120,3 +120,122 @@ def test_evalitem_simple_max_score():
     assert score == 1
     score = i1.max_score(i2, matcher=lambda x, y, check_condition: [0, 0], check_condition=True)
     assert score == 0
+
+
+def test_apply_with_plan():
+    """
+    Test Metrics apply_with_plan reuses compiled dispatch and gives the same score as apply
+    """
+    result_1 = [{"from_name": "image1", "type": "polygonlabels",
+                 "value": {"points": [[1, 1], [1, 20], [20, 20], [20, 1]], "polygonlabels": ["Engine"]}},
+                {"from_name": "image", "type": "labels",
+                 "value": {"start": 0, "end": 10, "labels": ["Engine1"]}}]
+    result_2 = [{"from_name": "image1", "type": "polygonlabels",
+                 "value": {"points": [[1, 1], [1, 20], [20, 20], [20, 1]], "polygonlabels": ["Engine"]}},
+                {"from_name": "image", "type": "labels",
+                 "value": {"start": 11, "end": 20, "labels": ["Engine2"]}}]
+    project = {"control_weights": {"image": {"overall": 0.5}}, "metric_params": {"__backup": 1}}
+    plan = Metrics.compile(project)
+    assert Metrics.apply_with_plan(plan, result_1, result_2) == Metrics.apply(project, result_1, result_2)
+    assert Metrics.apply_with_plan(plan, result_1, result_1) == 1
+    dispatch = plan.get_control_dispatch("image", "labels")
+    assert dispatch is plan.get_control_dispatch("image", "labels")
+    assert dispatch.overall_weight == 0.5
+    assert "__backup" not in dispatch.params
+    assert project["metric_params"] == {"__backup": 1}
+
+
+def test_apply_with_partitioned_results():
+    """
+    Test Metrics apply_with_plan with results partitioned by from_name
+    """
+    result_1 = [{"from_name": "image", "type": "labels",
+                 "value": {"start": 0, "end": 10, "labels": ["Engine1"]}},
+                {"from_name": "image", "type": "labels",
+                 "value": {"start": 11, "end": 20, "labels": ["Engine2"]}},
+                {"type": "relation", "from_id": "a", "to_id": "b"}]
+    result_2 = [{"from_name": "image", "type": "labels",
+                 "value": {"start": 0, "end": 10, "labels": ["Engine1"]}}]
+    partition_1 = Metrics.partition_results_by_from_name(result_1)
+    partition_2 = Metrics.partition_results_by_from_name(result_2)
+    assert partition_1.controls == {"image": "labels"}
+    assert len(partition_1.get("image")) == 2
+    assert partition_1.get("unknown") == []
+    plan = Metrics.compile({})
+    assert Metrics.apply_with_plan(plan, partition_1, partition_2) == Metrics.apply({}, result_1, result_2)
+    assert Metrics.apply_with_plan(plan, partition_1, result_2) == Metrics.apply({}, result_1, result_2)
+
+
+def test_apply_symmetric_metric_single_call(monkeypatch):
+    """
+    Test Metrics apply calls symmetric metric only once per control
+    """
+    # test metrics are registered into the copy of registry
+    monkeypatch.setattr(Metrics, '_metrics', dict(Metrics._metrics))
+    calls = []
+
+    def counting_match(x, y, **kwargs):
+        calls.append((x, y))
+        return 0.5
+
+    Metrics.register(name='symmetric_test', form='', tag='SymmetricTest', func=counting_match,
+                     desc='symmetric', symmetric=True)
+    Metrics.register(name='asymmetric_test', form='', tag='AsymmetricTest', func=counting_match,
+                     desc='asymmetric')
+    assert Metrics.get_default_metric_for_tag('symmetrictest').symmetric
+    assert not Metrics.get_default_metric_for_tag('asymmetrictest').symmetric
+    result_1 = [{"from_name": "c1", "type": "symmetrictest", "value": {}}]
+    result_2 = [{"from_name": "c1", "type": "symmetrictest", "value": {"x": 1}}]
+    assert Metrics.apply({}, result_1, result_2) == 0.5
+    assert len(calls) == 1
+    result_1 = [{"from_name": "c1", "type": "asymmetrictest", "value": {}}]
+    result_2 = [{"from_name": "c1", "type": "asymmetrictest", "value": {"x": 1}}]
+    assert Metrics.apply({}, result_1, result_2) == 0.5
+    assert len(calls) == 3
+
+
+def test_apply_symmetric_edit_distance():
+    """
+    Test TextArea edit distance is scored with a single call and doesn't depend on the order of results
+    """
+    assert Metrics.compile({}).get_control_dispatch('text', 'textarea').symmetric
+    result_1 = [{"from_name": "text", "type": "textarea", "value": {"text": ["kitten", "flaw"]}}]
+    result_2 = [{"from_name": "text", "type": "textarea", "value": {"text": ["sitting", "lawn"]}}]
+    score = Metrics.apply({}, result_1, result_2)
+    assert 0 < score < 1
+    assert score == Metrics.apply({}, result_2, result_1) == Metrics.apply({}, result_1, result_2, symmetric=False)
+
+
+def test_apply_asymmetric_edit_distance_algorithm():
+    """
+    Test TextArea edit distance by asymmetric algorithm is scored in both directions
+    """
+    project = {"metric_params": {"algorithm": "MongeElkan", "qval": 1}}
+    assert not Metrics.compile(project).get_control_dispatch('text', 'textarea').symmetric
+    result_1 = [{"from_name": "text", "type": "textarea", "value": {"text": ["ab ab"]}}]
+    result_2 = [{"from_name": "text", "type": "textarea", "value": {"text": ["ab ba aa"]}}]
+    forward = Metrics.apply(project, result_1, result_2, symmetric=False)
+    backward = Metrics.apply(project, result_2, result_1, symmetric=False)
+    assert forward != backward
+    assert Metrics.apply(project, result_1, result_2) == min(forward, backward)
+
+
+def test_similarity_matrix_and_average():
+    """
+    Test Metrics similarity_matrix matches pairwise Metrics.apply and feeds Metrics.average
+    """
+    results = [
+        [{"from_name": "image", "type": "labels", "value": {"start": 0, "end": 10, "labels": ["Engine1"]}}],
+        [{"from_name": "image", "type": "labels", "value": {"start": 0, "end": 10, "labels": ["Engine1"]}}],
+        [{"from_name": "image", "type": "labels", "value": {"start": 0, "end": 5, "labels": ["Engine1"]}}],
+    ]
+    matrix = Metrics.similarity_matrix({}, results)
+    assert matrix.shape == (3, 3)
+    assert (matrix == matrix.T).all()
+    assert (matrix.diagonal() == 0).all()
+    for i in range(3):
+        for j in range(i + 1, 3):
+            assert matrix[i, j] == Metrics.apply({}, results[i], results[j])
+    average = Metrics.average({}, results)
+    assert type(average) is float
+    assert average == (matrix[0, 1] + matrix[0, 2] + matrix[1, 2]) / 3
@@ -1,6 +1,15 @@
+from collections import Counter
+
+import numpy as np
 import pytest
+from shapely.geometry import Polygon
+
+import evalme.utils
+from evalme.utils import POLYGON_REPAIRS, _try_build_poly, _self_intersections, _remove_points
 
-from evalme.image.object_detection import KeyPointsEvalItem, keypoints_distance, PolygonObjectDetectionEvalItem, OCREvalItem, ocr_compare
+from evalme.image.object_detection import KeyPointsEvalItem, keypoints_distance, PolygonObjectDetectionEvalItem, OCREvalItem, ocr_compare, \
+    BboxObjectDetectionEvalItem, mAP_bboxes, COCO_IOU_THRESHOLDS, iou_bboxes, iou_bboxes_assignment, \
+    precision_bboxes_assignment, recall_bboxes_assignment, f1_bboxes_assignment
 
 
 def test_keypoints_matching():
@@ -990,3 +999,188 @@ def test_ocr_polygon_shape():
     per_label_score = obj2.compare(obj1, per_label=True)
     assert per_label_score[0] == {'Text': 1.0}
     assert per_label_score[1] == {'Text': 1}
+
+
+def test_bbox_iou_matrix():
+    """
+    Vectorized bbox IOU matrix is the same as pairwise IOU
+    """
+    gt = BboxObjectDetectionEvalItem([
+        {"value": {"x": 0, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+        {"value": {"x": 5, "y": 5, "width": 10, "height": 20.5, "rectanglelabels": ["Airplane"]}},
+    ])
+    pred = BboxObjectDetectionEvalItem([
+        {"value": {"x": 2, "y": 3, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+        {"value": {"x": 50, "y": 50, "width": 1, "height": 1, "rectanglelabels": ["Car"]}},
+        {"value": {"x": 6.5, "y": 4, "width": 7, "height": 12, "rectanglelabels": ["Airplane"]}},
+    ])
+    matrix = gt._iou_matrix(pred)
+    assert matrix.shape == (2, 3)
+    for i, x in enumerate(gt.get_values()):
+        for j, y in enumerate(pred.get_values()):
+            assert matrix[i, j] == gt._iou(x, y)
+    labels_match = gt._labels_match_matrix(pred)
+    assert labels_match.tolist() == [[True, True, False], [False, False, True]]
+
+
+def test_bbox_mAP_thresholds_sweep():
+    """
+    mAP from a single IOU matrix is the same as precision and recall evaluated per threshold
+    """
+    gt = [{"value": {"x": 0, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+          {"value": {"x": 20, "y": 20, "width": 10, "height": 10, "rectanglelabels": ["Car"]}}]
+    pred = [{"value": {"x": 1, "y": 1, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+            {"value": {"x": 24, "y": 22, "width": 10, "height": 10, "rectanglelabels": ["Car"]}}]
+    item_gt = BboxObjectDetectionEvalItem(gt)
+    item_pred = BboxObjectDetectionEvalItem(pred)
+    for coco, thresholds in [(False, np.arange(0.2, 0.5, 0.05)), (True, COCO_IOU_THRESHOLDS)]:
+        precisions = [item_pred.precision_at_iou(item_gt, t) for t in thresholds] + [1]
+        recalls = [item_pred.recall_at_iou(item_gt, t) for t in thresholds] + [0]
+        expected = sum((recalls[i] - recalls[i + 1]) * precisions[i] for i in range(len(thresholds)))
+        assert mAP_bboxes(gt, pred, coco=coco) == pytest.approx(expected)
+    assert mAP_bboxes(gt, pred, coco=True) < mAP_bboxes(gt, pred)
+
+
+def test_polygon_built_once_per_item():
+    """
+    Each polygon is built once per item and reused for all pairs
+    """
+    square = [[0, 0], [10, 0], [10, 10], [0, 10]]
+    shifted = [[5, 0], [15, 0], [15, 10], [5, 10]]
+    far = [[50, 50], [60, 50], [60, 60], [50, 60]]
+    gt = PolygonObjectDetectionEvalItem([
+        {"value": {"points": square, "polygonlabels": ["Car"]}},
+        {"value": {"points": far, "polygonlabels": ["Car"]}},
+    ])
+    pred = PolygonObjectDetectionEvalItem([
+        {"value": {"points": shifted, "polygonlabels": ["Car"]}},
+        {"value": {"points": square, "polygonlabels": ["Car"]}},
+    ])
+    matrix = gt._iou_matrix(pred)
+    assert matrix.tolist() == [[pytest.approx(1 / 3), 1], [0, 0]]
+    gt.mAP_at_iou(pred)
+    assert gt._polygons.misses == 2
+    assert len(gt._polygons) == 2
+    assert gt._polygons.hits > 0
+    assert pred._polygons.misses == 2
+
+
+def test_polygon_iou_matrix_candidates():
+    """
+    IOU matrix from intersecting candidate pairs is the same as IOU computed for each pair
+    """
+    rng = np.random.default_rng(0)
+
+    def polygons(n):
+        result = []
+        for _ in range(n):
+            center = rng.uniform(0, 100, 2)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 6))
+            radius = rng.uniform(1, 15, 6)
+            points = center + np.stack([np.cos(angles), np.sin(angles)], axis=1) * radius[:, None]
+            result.append({"value": {"points": points.tolist(), "polygonlabels": [str(rng.integers(2))]}})
+        return result
+
+    gt = PolygonObjectDetectionEvalItem(polygons(30))
+    pred = PolygonObjectDetectionEvalItem(polygons(25) + [{"value": {"polygonlabels": ["0"]}}])
+    matrix = gt._iou_matrix(pred)
+    for i, x in enumerate(gt.get_values()):
+        for j, y in enumerate(pred.get_values()):
+            assert matrix[i, j] == gt._iou(x, y)
+    labels_match = gt._labels_match_matrix(pred)
+    assert np.array_equal(gt._iou_matrix(pred, mask=labels_match), np.where(labels_match, matrix, 0))
+
+
+def test_polygon_repair_stages():
+    """
+    Self-intersected polygon is repaired by the first successful stage, stages are counted
+    """
+    bowtie = [[0, 0], [10, 10], [10, 0], [0, 10]]
+    assert _self_intersections(bowtie) == [(5.0, 5.0)]
+    assert _self_intersections([[0, 0], [10, 0], [10, 10], [0, 10]]) == []
+    stats = Counter()
+    p = PolygonObjectDetectionEvalItem(raw_data=None, polygon_repair_stats=stats)
+    assert p._try_build_poly(bowtie).is_valid
+    assert stats == {'make_valid': 1}
+    p = PolygonObjectDetectionEvalItem(raw_data=None, polygon_repair_stages=['convex_hull', 'remove_points'],
+                                       polygon_repair_stats=stats)
+    with pytest.raises(ValueError):
+        p._try_build_poly(bowtie)
+    assert stats['failed'] == 1
+    p = PolygonObjectDetectionEvalItem(raw_data=None, polygon_repair_stages=['polygonize'],
+                                       polygon_repair_stats=stats)
+    assert p._try_build_poly(bowtie).area == 25
+    assert stats['polygonize'] == 1
+
+
+def test_polygon_repair_invalid_make_valid_is_chained(monkeypatch):
+    """
+    Stages after make_valid repair its output when it's still invalid
+    """
+    bowtie = [[0, 0], [10, 10], [10, 0], [0, 10]]
+    repaired = []
+
+    def convex_hull(poly, points):
+        repaired.append(poly)
+        return poly.convex_hull
+
+    invalid = Polygon([[0, 0], [10, 10], [10, 0], [0, 10], [0, 0]])
+    monkeypatch.setitem(POLYGON_REPAIRS, 'make_valid', lambda poly, points: invalid)
+    monkeypatch.setitem(POLYGON_REPAIRS, 'convex_hull', convex_hull)
+    assert _try_build_poly(bowtie, stages=['make_valid', 'convex_hull']).area == 100
+    assert len(repaired) == 1 and repaired[0] is invalid
+
+
+def test_polygon_remove_points_rounds(monkeypatch):
+    """
+    Points nearest to self-intersections are removed in a bounded number of rounds
+    """
+    points = [[0, 0], [10, 0], [10, 10], [5, 10], [5.2, 9.8], [5.2, 10.5], [4.8, 10.5], [4.8, 9.8], [5.1, 10], [0, 10]]
+    poly = Polygon(points)
+    assert not poly.is_valid
+    assert len(_self_intersections(points)) == 5
+    fixed = _remove_points(poly, points)
+    assert fixed.is_valid
+    assert fixed.area == pytest.approx(poly.area, rel=0.1)
+    # without rounds no points are removed
+    monkeypatch.setattr(evalme.utils, 'POLYGON_REMOVE_POINTS_ROUNDS', 0)
+    assert not _remove_points(poly, points).is_valid
+
+
+def test_bbox_assignment_matching():
+    """
+    Each ground truth box is matched at most once, unlike max IOU per prediction
+    """
+    gt = [{"value": {"x": 0, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+          {"value": {"x": 50, "y": 50, "width": 10, "height": 10, "rectanglelabels": ["Car"]}}]
+    pred = [{"value": {"x": 0, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+            {"value": {"x": 1, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+            {"value": {"x": 50, "y": 50, "width": 10, "height": 10, "rectanglelabels": ["Airplane"]}}]
+    assert iou_bboxes(gt, pred) == pytest.approx((1 + 0.9 / 1.1 + 0) / 3)
+    assert iou_bboxes_assignment(gt, pred) == pytest.approx(1 / 3)
+    assert iou_bboxes_assignment(gt, pred, per_label=True) == {"Car": 0.5, "Airplane": 0}
+    assert precision_bboxes_assignment(gt, pred) == pytest.approx(1 / 3)
+    assert recall_bboxes_assignment(gt, pred) == 0.5
+    assert f1_bboxes_assignment(gt, pred) == pytest.approx(0.4)
+    assert precision_bboxes_assignment(gt, pred, per_label=True) == {"Car": 0.5, "Airplane": 0}
+    assert recall_bboxes_assignment(gt, pred, per_label=True) == {"Car": 0.5, "Airplane": 0}
+    assert precision_bboxes_assignment(gt, pred, label_weights={"Airplane": 2}) == 0.25
+    assert f1_bboxes_assignment(gt, [], per_label=True) == {"Car": 0}
+
+
+def test_bbox_assignment_is_optimal():
+    """
+    Assignment maximizes total IOU where greedy matching takes the best pair first
+    """
+    gt = BboxObjectDetectionEvalItem([
+        {"value": {"x": 0, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+        {"value": {"x": 4, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+    ])
+    pred = BboxObjectDetectionEvalItem([
+        {"value": {"x": 2, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+        {"value": {"x": -3, "y": 0, "width": 10, "height": 10, "rectanglelabels": ["Car"]}},
+    ])
+    rows, cols, ious = pred._assignment(gt)
+    assert sorted(zip(rows.tolist(), cols.tolist())) == [(0, 1), (1, 0)]
+    matrix = pred._iou_matrix(gt)
+    assert ious.sum() == pytest.approx(max(matrix[0, 0] + matrix[1, 1], matrix[0, 1] + matrix[1, 0]))
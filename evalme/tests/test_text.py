@@ -1,5 +1,7 @@
 import pytest
-from evalme.text.text import HTMLTagsEvalItem, TaxonomyEvalItem, intersection_taxonomy, path_match_taxonomy
+from evalme.text.text import HTMLTagsEvalItem, TaxonomyEvalItem, TextTagsEvalItem, intersection_taxonomy, \
+    path_match_taxonomy
+from evalme.utils import LabelConfigsCache, label_configs_cache, parse_config_to_json
 
 
 def test_not_matching():
@@ -968,3 +970,81 @@ def test_taxonomy_nested_label_config_with_added_label():
     assert pred == 1.0
     pred_vice = intersection_taxonomy(tree_subview_with_new_label1, tree_subview_1, label_config=label_config_subview, control_name='taxonomy')
     assert pred_vice == 0.2
+
+
+def test_text_tags_labels_index():
+    """
+    Predicted spans are matched only with identically labeled gt spans
+    """
+    gt = TextTagsEvalItem([
+        {"value": {"start": 0, "end": 10, "labels": ["PER"]}},
+        {"value": {"start": 0, "end": 10, "labels": ["ORG"]}},
+        {"value": {"start": 5, "end": 10, "labels": ["PER"]}},
+    ])
+    pred = TextTagsEvalItem([
+        {"value": {"start": 5, "end": 10, "labels": ["PER"]}},
+        {"value": {"start": 0, "end": 10, "labels": ["LOC"]}},
+    ])
+    assert gt._labels_index() == {("PER",): [0, 2], ("ORG",): [1]}
+    assert gt.intersection(pred) == 0.5
+    assert gt.intersection(pred, per_label=True) == {"PER": 1, "LOC": 0}
+    assert gt.intersection(pred, algorithm="Levenshtein", qval=1) == 0.5
+
+
+def test_text_tags_spans_index():
+    """
+    Predicted spans are compared only with overlapping gt spans, results are the same as for all spans
+    """
+    gt = TextTagsEvalItem([
+        {"value": {"start": 0, "end": 10, "labels": ["PER"]}},
+        {"value": {"start": "20", "end": "30", "labels": ["PER"]}},
+        {"value": {"start": 25, "end": 40, "labels": ["ORG"]}},
+    ])
+    pred = TextTagsEvalItem([
+        {"value": {"start": 22, "end": 30, "labels": ["PER"]}},
+        {"value": {"start": 10, "end": 20, "labels": ["PER"]}},
+        {"value": {"start": 50, "end": 60, "labels": ["ORG"]}},
+    ])
+    assert gt._candidates(pred, 0) == [1, 2]
+    assert gt._candidates(pred, 0, by_labels=True) == [1]
+    assert gt._candidates(pred, 2, by_labels=True) == []
+    assert gt.intersection(pred) == pytest.approx(0.8 / 3)
+    assert gt.intersection(pred, iou_threshold=0.5) == pytest.approx(1 / 3)
+    assert gt.intersection(pred, per_label=True) == {"PER": 0.4, "ORG": 0}
+    assert gt.intersection(pred, algorithm="Levenshtein", qval=1) == pytest.approx(0.8 / 3)
+
+
+def test_taxonomy_tree_cached_per_config():
+    label_configs_cache.clear()
+    tree = TaxonomyEvalItem._tree(label_config, control_name='taxonomy')
+    assert set(tree) == {'A', 'B', 'C'}
+    assert TaxonomyEvalItem._tree(label_config, control_name='taxonomy') is tree
+    assert TaxonomyEvalItem._tree(label_config_with_leaf, control_name='taxonomy') is not tree
+    # label config json is shared by trees of all controls
+    assert label_configs_cache.misses == 4
+    assert label_configs_cache.hits == 1
+
+    cache = LabelConfigsCache(max_size=1)
+    cache.get(label_config, 'json', len)
+    cache.get(label_config_with_leaf, 'json', len)
+    cache.get(label_config, 'json', len)
+    assert cache.misses == 3 and len(cache._objects) == 1
+
+    config = parse_config_to_json(label_config)
+    config['View'].clear()
+    assert parse_config_to_json(label_config) != config
+    # lxml error is kept, config is not hashed
+    with pytest.raises((TypeError, ValueError)):
+        parse_config_to_json(None)
+    assert cache.get(None, 'json', lambda config_string: 'built') == 'built'
+    assert cache.misses == 3 and len(cache._objects) == 1
+
+
+def test_taxonomy_paths_index():
+    index = TaxonomyEvalItem._index(label_config, control_name='taxonomy')
+    assert index[('A', 'AA')] == (('A', 'AA', 'AAB'), ('A', 'AA', 'AAC'))
+    assert index[('A',)] == (('A', 'AA', 'AAB'), ('A', 'AA', 'AAC'), ('A', 'AB'), ('A', 'AC'))
+    assert index[('B', 'BA')] == (('B', 'BA'),)
+    # leaf paths are shared by all ancestors
+    assert index[('A',)][0] is index[('A', 'AA')][0]
+    assert TaxonomyEvalItem._expand(index, [['C', 'CA'], ['X']]) == [('C', 'CA'), ('X',)]
@@ -1,5 +1,6 @@
 import pytest
-from evalme.text.text import intersection_text_tagging
+from evalme.eval_item import EvalItem
+from evalme.text.text import intersection_text_tagging, TextTagsEvalItem
 
 
 def test_same_timeseries_labels():
@@ -57,4 +58,24 @@ def test_different_timeseries_labels():
     feature_flags = {}
     feature_flags['ff_back_dev_2762_textarea_weights_30062022_short'] = True
     assert round(intersection_text_tagging([test_data[0]], [test_data[1]], shape_key='timeserieslabels', feature_flags=feature_flags)) == 0
-    assert round(intersection_text_tagging([test_data[1]], [test_data[0]], shape_key='timeserieslabels', feature_flags=feature_flags)) == 0
\ No newline at end of file
+    assert round(intersection_text_tagging([test_data[1]], [test_data[0]], shape_key='timeserieslabels', feature_flags=feature_flags)) == 0
+
+
+def test_timeseries_spans_iou_matrix():
+    """
+    Datetime spans are parsed once per item and compared as epoch microseconds
+    """
+    gt = TextTagsEvalItem([
+        {"value": {"start": "2022-12-26 12:00:00", "end": "2022-12-26 13:00:00", "timeserieslabels": ["A"]}},
+        {"value": {"start": "2022-12-26T14:00:00", "end": "2022-12-26T14:00:00.5", "timeserieslabels": ["A"]}},
+    ], shape_key='timeserieslabels')
+    pred = TextTagsEvalItem([
+        {"value": {"start": "2022-12-26 12:30:00", "end": "2022-12-26 13:30:00", "timeserieslabels": ["A"]}},
+        {"value": {"start": "2022-12-26 14:00:00.25", "end": "2022-12-26 15:00:00", "timeserieslabels": ["B"]}},
+    ], shape_key='timeserieslabels')
+    assert gt._spans_arrays().kind == 'datetime'
+    matrix = gt._spans_iou_matrix(pred)
+    for i, x in enumerate(gt.get_values()):
+        for j, y in enumerate(pred.get_values()):
+            assert matrix[i, j] == EvalItem.spans_iou(x, y)
+    assert intersection_text_tagging(gt, pred, shape_key='timeserieslabels') == pytest.approx(1 / 6)
@@ -1,6 +1,125 @@
-from evalme.utils import texts_similarity
+import random
+
+import pytest
+import textdistance
+from dateutil import parser
+
+from evalme.utils import texts_similarity, SpansIndex, DatetimeParser, ends_overlap_ratio, longest_prefix_occurrence, \
+    TextComparator, bounded_levenshtein
 
 
 def test_texts_similarity():
     result = texts_similarity(x="1", y="1234", f=lambda x, y: int(x==y))
-    assert result == 0.25
\ No newline at end of file
+    assert result == 0.25
+
+
+def test_spans_index_overlapping():
+    rng = random.Random(0)
+    spans = []
+    for _ in range(200):
+        start = rng.randint(0, 500)
+        spans.append((start, start + rng.randint(-5, 40)))
+    # single long span doesn't widen search of short spans
+    spans.append((-1000, 100000))
+    index = SpansIndex(range(len(spans)), *zip(*spans))
+    assert len(index) == len(spans)
+    assert max(max_length for _, _, _, max_length in index._classes[:-1]) <= 64
+    for _ in range(100):
+        start = rng.randint(-10, 510)
+        end = start + rng.randint(0, 30)
+        expected = [i for i, (s, e) in enumerate(spans) if s <= end and e >= start]
+        assert index.overlapping(start, end) == expected
+
+
+def test_datetime_parser_cache():
+    datetimes = DatetimeParser(max_size=2)
+    for value in ["2022-12-26 12:33:37", "2022-12-26T12:33:37.5+02:00", "2022-12-26T12:33:37Z", "Dec 26 2022"]:
+        assert datetimes.parse(value) == parser.parse(value)
+    assert datetimes.misses == 4
+    assert datetimes.parse("Dec 26 2022") == parser.parse("Dec 26 2022")
+    assert datetimes.hits == 1
+    assert len(datetimes._datetimes) == 2
+
+
+def most_common_ends(text1, text2):
+    """
+    Reference text overlap growing the common prefix by one character
+    """
+    ind = 0
+    for i in range(1, len(text2)):
+        if text2[:i] in text1:
+            ind = i
+            continue
+        else:
+            break
+    if text1.endswith(text2[:ind]):
+        return ind / (len(text1) + len(text2) - ind)
+    else:
+        return -1
+
+
+def test_text_overlap():
+    rng = random.Random(0)
+    for _ in range(500):
+        text1 = ''.join(rng.choice('ab ') for _ in range(rng.randint(0, 30)))
+        text2 = ''.join(rng.choice('ab ') for _ in range(rng.randint(0, 30)))
+        assert ends_overlap_ratio(text1, text2) == most_common_ends(text1, text2)
+        assert longest_prefix_occurrence(text1, text2) == max(
+            i for i in range(len(text2) + 1) if text2[:i] in text1)
+
+
+def test_text_comparator_cache():
+    comparator = TextComparator('Levenshtein', 1)
+    pairs = [("kitten", "sitting"), ("", ""), ("flaw", "lawn"), ("kitten", "sitting")]
+    expected = [textdistance.Levenshtein(qval=1).normalized_similarity(x, y) for x, y in pairs]
+    assert comparator.batch(pairs) == expected
+    assert comparator.misses == 3
+    assert comparator("flaw", "lawn") == expected[2]
+    assert comparator.hits == 1
+    assert texts_similarity(["kitten", "flaw", "extra"], ["sitting", "lawn"], comparator) == (expected[0] + expected[2]) / 3
+
+    # external distance backend is normalized the same way as textdistance
+    comparator = TextComparator('Levenshtein', 1)
+    comparator._distance = textdistance.Levenshtein(qval=1, external=False).distance
+    assert comparator.batch(pairs) == expected
+
+    # cache is bounded by total length of texts
+    comparator = TextComparator('Levenshtein', 1, max_length=20)
+    comparator.batch(pairs + [("a" * 30, "b")])
+    assert list(comparator._scores) == [("", ""), ("flaw", "lawn")]
+    comparator("abcdef", "abcdefgh")
+    assert list(comparator._scores) == [("abcdef", "abcdefgh")]
+    assert comparator._length == 14
+
+
+def test_text_comparator_rapidfuzz():
+    pytest.importorskip('rapidfuzz')
+    comparator = TextComparator('Levenshtein', 1)
+    assert comparator._distance is not None
+    levenshtein = textdistance.Levenshtein(qval=1, external=False)
+    rng = random.Random(0)
+    for _ in range(500):
+        x = ''.join(rng.choice('abc ') for _ in range(rng.randint(0, 20)))
+        y = ''.join(rng.choice('abc ') for _ in range(rng.randint(0, 20)))
+        similarity = levenshtein.normalized_similarity(x, y)
+        assert comparator(x, y) == similarity
+        min_similarity = rng.random()
+        bounded = TextComparator('Levenshtein', 1).bounded(x, y, min_similarity)
+        assert bounded == (similarity if similarity > min_similarity else None)
+
+
+def test_bounded_levenshtein():
+    levenshtein = textdistance.Levenshtein(qval=1)
+    for x, y in [("kitten", "sitting"), ("", "abc"), ("flaw", "lawn"), ("abcdef", "abcdef"), ("abc", "cba")]:
+        distance = levenshtein.distance(x, y)
+        for max_distance in range(-1, 8):
+            expected = distance if distance <= max_distance else max_distance + 1
+            assert bounded_levenshtein(x, y, max_distance) == expected
+
+    comparator = TextComparator('Levenshtein', 1)
+    similarity = levenshtein.normalized_similarity("kitten", "sitting")
+    assert comparator.bounded("kitten", "sitting", similarity - 0.01) == similarity
+    assert comparator.bounded("kitten", "sitting", similarity) is None
+    # length ratio alone rejects the pair
+    assert comparator.bounded("a", "abcdefgh", 0.5) is None
+    assert texts_similarity(["kitten", "flaw"], ["sitting", "lawn"], comparator, min_score=0.9) == 0
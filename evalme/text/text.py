@@ -1,18 +1,27 @@
 import itertools
-from copy import deepcopy
+import math
 from functools import partial
 from collections import defaultdict
 
 from evalme.eval_item import EvalItem
-from evalme.utils import texts_similarity, get_text_comparator, parse_config_to_json
+from evalme.utils import texts_similarity, get_text_comparator, _parse_config_to_json, _hashable, SpansIndex, \
+    ends_overlap_ratio, SCORE_BOUND_TOLERANCE, label_configs_cache
 import logging
 logger = logging.getLogger(__name__)
 
+# textdistance algorithms with similarity independent of the order of compared texts
+SYMMETRIC_TEXT_ALGORITHMS = {'Hamming', 'Levenshtein', 'DamerauLevenshtein', 'Jaro', 'JaroWinkler',
+                             'Jaccard', 'Sorensen', 'Cosine', 'Overlap', 'Tanimoto', 'Bag', 'LCSSeq', 'LCSStr'}
+
 
 class TextTagsEvalItem(EvalItem):
 
     SHAPE_KEY = 'labels'
 
+    def __init__(self, raw_data, shape_key=None, **kwargs):
+        super(TextTagsEvalItem, self).__init__(raw_data, shape_key=shape_key, **kwargs)
+        self._spans_indices = {}
+
     def spans_iou(self, x, y):
         s1, e1 = float(x['start']), float(x['end'])
         s2, e2 = float(y['start']), float(y['end'])
@@ -25,15 +34,69 @@ class TextTagsEvalItem(EvalItem):
         iou = intersection / union
         return iou
 
-    def _match(self, x, y, f):
-        region = EvalItem.has_regions([x, y])
-        if region:
-            spans_match = EvalItem.general_iou_by_type(region, x, y)
-        else:
-            spans_match = 0
+    def _spans_index(self, by_labels=False):
+        """
+        Interval indices of spans by (labels key if by_labels, span group), built once per item
+        :return: dict {(labels key, group): SpansIndex} or None if values can't be converted to spans
+        """
+        if by_labels not in self._spans_indices:
+            spans = self._spans_arrays()
+            groups = None
+            if spans.kind is not None:
+                groups = defaultdict(list)
+                for i, value in enumerate(self.get_values_iter()):
+                    groups[self._labels_key(value) if by_labels else None, spans.groups[i]].append(i)
+                groups = {key: SpansIndex(indices, spans.starts[indices], spans.ends[indices])
+                          for key, indices in groups.items()}
+            self._spans_indices[by_labels] = groups
+        return self._spans_indices[by_labels]
+
+    def _candidates(self, item, j, by_labels=False):
+        """
+        Indices of gt values which can have nonzero matching score with j-th value of item, None if all can
+        :param by_labels: only identically labeled gt values match
+        """
+        labels_key = self._labels_key(item.raw_data[j]['value'])
+        by_labels = by_labels and labels_key is not None
+        spans_index = self._spans_index(by_labels)
+        item_spans = item._spans_arrays()
+        if spans_index is not None and item_spans.kind == self._spans_arrays().kind:
+            # not overlapping spans have zero IOU
+            index = spans_index.get((labels_key if by_labels else None, item_spans.groups[j]))
+            return index.overlapping(item_spans.starts[j], item_spans.ends[j]) if index is not None else []
+        if by_labels:
+            return self._labels_index().get(labels_key, [])
+        return None
+
+    def _labels_min_score(self, spans_match, min_score):
+        """
+        Labels similarity which isn't enough for the matching score to exceed min_score, None if there is no such bound
+        """
+        if min_score is None or min_score <= 0:
+            return None
+        if self._kwargs.get('ff_back_dev_2762_textarea_weights_30062022_short'):
+            # threshold is applied to labels similarity
+            return min_score
+        if spans_match <= 0:
+            return None
+        return min_score / spans_match * (1 - SCORE_BOUND_TOLERANCE)
+
+    def _match(self, x, y, f, spans_match=None, min_score=None):
+        """
+        Matching score of gt value x and predicted value y
+        :param spans_match: precomputed spans IOU
+        :param min_score: scores not greater than min_score can be returned as 0
+        """
+        if spans_match is None:
+            region = EvalItem.has_regions([x, y])
+            if region:
+                spans_match = EvalItem.general_iou_by_type(region, x, y, self._polygons)
+            else:
+                spans_match = 0
         if spans_match == 0 and not self._kwargs.get('ff_back_dev_2762_textarea_weights_30062022_short'):
             return 0
-        labels_match = texts_similarity(x[self._shape_key], y[self._shape_key], f)
+        labels_match = texts_similarity(x[self._shape_key], y[self._shape_key], f,
+                                        self._labels_min_score(spans_match, min_score))
 
         # TODO: workaround for DEV-2762
         if self._kwargs.get('ff_back_dev_2762_textarea_weights_30062022_short'):
@@ -51,25 +114,45 @@ class TextTagsEvalItem(EvalItem):
             return {} if per_label else 1
 
         gt_values = self.get_values()
+        # with labels equality only identically labeled gt spans can have nonzero matching score
+        by_spans_weight = self._kwargs.get('ff_back_dev_2762_textarea_weights_30062022_short')
+        by_labels = comparator is None and not by_spans_weight
         if per_label:
             total_score, total_weight = defaultdict(int), defaultdict(int)
         else:
             total_score, total_weight = 0, 0
-        for pred_value in item.get_values_iter():
+        # spans IOU of all pairs is computed at once if spans can be converted to arrays
+        ious = self._spans_iou_matrix(item) if gt_values else None
+        for j, pred_value in enumerate(item.get_values_iter()):
             if len(gt_values) == 0:
                 # for empty gt values, matching score for current prediction is the lowest
                 best_matching_score = 0
             else:
-                # find the best matching span inside gt_values
+                # find the best matching span among gt values which can match
+                candidates = self._candidates(item, j, by_labels)
+                if candidates is None:
+                    candidates = range(len(gt_values))
+                scores = []
+                for i in candidates:
+                    scores.append(self._match(gt_values[i], pred_value, comparator,
+                                              ious[i, j].item() if ious is not None else None, iou_threshold))
+                    if iou_threshold is not None and not by_spans_weight and scores[-1] > iou_threshold:
+                        # hard decision is made by the first gt value matched above threshold
+                        break
                 if self._kwargs.get('ff_back_dev_2762_textarea_weights_30062022_short'):
-                    best_matching_score = max(map(partial(self._match, y=pred_value, f=comparator), gt_values),
-                                              key=lambda r: r[1])
+                    if len(candidates) < len(gt_values):
+                        # skipped gt values have zero spans match
+                        scores.append((0, 0))
+                    best_matching_score = max(scores, key=lambda r: r[1])
                     if best_matching_score[1] == 0:
                         best_matching_score = 0
                     else:
                         best_matching_score = best_matching_score[0]
                 else:
-                    best_matching_score = max(map(partial(self._match, y=pred_value, f=comparator), gt_values))
+                    if len(candidates) < len(gt_values):
+                        # skipped gt values have zero matching score
+                        scores.append(0)
+                    best_matching_score = max(scores)
                 if iou_threshold is not None:
                     # make hard decision w.r.t. threshold whether current spans are matched
                     best_matching_score = float(best_matching_score > iou_threshold)
@@ -150,42 +233,45 @@ class HTMLTagsEvalItem(TextTagsEvalItem):
         if text2 in text1:
             return len(text2) / len(text1)
 
-        def _most_common_ends(text1, text2):
-            # check if most common part of second text start is the end of text1
-            ind = 0
-            for i in range(1, len(text2)):
-                if text2[:i] in text1:
-                    ind = i
-                    continue
-                else:
-                    break
-            if text1.endswith(text2[:ind]):
-                return ind / (len(text1) + len(text2) - ind)
-            else:
-                return -1
-
-        iou1 = _most_common_ends(text1, text2)
-        iou2 = _most_common_ends(text2, text1)
+        # check if most common part of one text start is the end of another text
+        iou1 = ends_overlap_ratio(text1, text2)
+        iou2 = ends_overlap_ratio(text2, text1)
         m = max(iou1, iou2)
         if m > 0:
             return m
         else:
             return 0
 
-    def spans_iou(self, x, y):
+    def _labels_key(self, value):
+        return _hashable(value.get(self._shape_key) or value.get('htmllabels'))
+
+    def _span_bounds(self, value):
+        # spans are matched by offsets inside the same start/end blocks
+        if not EvalItem.has_spans_with_offsets([value]):
+            return None
+        start, end = value['startOffset'], value['endOffset']
+        if not isinstance(start, (int, float)) or not isinstance(end, (int, float)):
+            return None
+        if not math.isfinite(start) or not math.isfinite(end):
+            return None
+        return 'offsets', (_hashable(value['start']), _hashable(value['end'])), start, end
+
+    def spans_iou(self, x, y, offsets_iou=None):
         # if labels are different returning 0 match
         x_set = set(x.get(self._shape_key, [])) or set(x.get('htmllabels', []))
         y_set = set(y.get(self._shape_key, [])) or set(y.get('htmllabels', []))
         if not (x_set == y_set):
             return 0
+        if offsets_iou is not None:
+            return offsets_iou
         # try using startOffset/endOffset for IOU
         return self._spans_iou_by_start_end_offsets(x, y)
 
-    def _match(self, x, y, f):
+    def _match(self, x, y, f, spans_match=None, min_score=None):
         x_res = x.get(self._shape_key) or x.get('htmllabels')
         y_res = y.get(self._shape_key) or y.get('htmllabels')
-        labels_match = texts_similarity(x_res, y_res, f)
-        spans_match = self.spans_iou(x, y)
+        spans_match = self.spans_iou(x, y, spans_match)
+        labels_match = texts_similarity(x_res, y_res, f, self._labels_min_score(spans_match, min_score))
         if self._kwargs.get('ff_back_dev_2762_textarea_weights_30062022_short'):
             return labels_match, spans_match
         return labels_match * spans_match
@@ -233,8 +319,8 @@ class TaxonomyEvalItem(EvalItem):
             logger.warning("No label config - returning simple score.")
             return self.spans_match(prediction, per_label=per_label)
 
-        # create Taxonomy tree from label config
-        master_tree = TaxonomyEvalItem._tree(label_config=label_config, control_name=control_name)
+        # create Taxonomy paths index from label config
+        index = TaxonomyEvalItem._index(label_config=label_config, control_name=control_name)
         # Get taxonomy results for Ground Truth and Predicted annotation
         gt = self.get_values_iter()
         pred = prediction.get_values_iter()
@@ -246,16 +332,11 @@ class TaxonomyEvalItem(EvalItem):
                 for item_gt in gt:
                     taxonomy_pred = item_pred['taxonomy']
                     taxonomy_gt = item_gt['taxonomy']
-                    taxonomy_pred_list = list()
-                    taxonomy_gt_list = list()
                     try:
-                        for item_pred_tx in taxonomy_pred:
-                            taxonomy_pred_list.extend(TaxonomyEvalItem._transform_tree(master_tree, item_pred_tx))
-                        for item_gt_tx in taxonomy_gt:
-                            taxonomy_gt_list.extend(TaxonomyEvalItem._transform_tree(master_tree, item_gt_tx))
-                        for item in taxonomy_pred_list:
-                            if item in taxonomy_gt_list:
-                                results[str(item[-1])] = label_weights.get(str(item[-1]), 1)
+                        taxonomy_pred_set = set(TaxonomyEvalItem._expand(index, taxonomy_pred))
+                        taxonomy_gt_set = set(TaxonomyEvalItem._expand(index, taxonomy_gt))
+                        for item in taxonomy_pred_set & taxonomy_gt_set:
+                            results[str(item[-1])] = label_weights.get(str(item[-1]), 1)
                     # if we couldn't transform to a tree, than fall to simple
                     except KeyError:
                         score = int(taxonomy_pred == taxonomy_gt)
@@ -265,24 +346,18 @@ class TaxonomyEvalItem(EvalItem):
             for item_pred in pred:
                 for item_gt in gt:
                     taxonomy_pred = item_pred['taxonomy']
-                    taxonomy_pred_list = []
                     taxonomy_gt = item_gt['taxonomy']
-                    taxonomy_gt_list = []
                     if taxonomy_pred == taxonomy_gt:
                         matches += 1
                         tasks += 1
                         break
                     else:
-                        # score counter for equal results that would be
-                        temp = 0
                         try:
-                            for item_pred_tx in taxonomy_pred:
-                                taxonomy_pred_list.extend(TaxonomyEvalItem._transform_tree(master_tree, item_pred_tx))
-                            for item_gt_tx in taxonomy_gt:
-                                taxonomy_gt_list.extend(TaxonomyEvalItem._transform_tree(master_tree, item_gt_tx))
-                            for item in taxonomy_pred_list:
-                                if item in taxonomy_gt_list:
-                                    temp += 1
+                            taxonomy_pred_list = TaxonomyEvalItem._expand(index, taxonomy_pred)
+                            taxonomy_gt_list = TaxonomyEvalItem._expand(index, taxonomy_gt)
+                            taxonomy_gt_set = set(taxonomy_gt_list)
+                            # overlapping predicted nodes count their common leaves for each node
+                            temp = sum(item in taxonomy_gt_set for item in taxonomy_pred_list)
                             matches += (temp / max(len(taxonomy_gt_list), 1))
                         # if we couldn't transform to a tree, than fall to simple equals
                         except KeyError:
@@ -319,6 +394,14 @@ class TaxonomyEvalItem(EvalItem):
 
     @staticmethod
     def _tree(label_config, control_name=None):
+        """
+        Creating Tree from label_config, built once per label config and control name
+        """
+        return label_configs_cache.get(label_config, ('taxonomy', control_name),
+                                       partial(TaxonomyEvalItem._build_tree, control_name=control_name))
+
+    @staticmethod
+    def _build_tree(label_config, control_name=None):
         """
         Creating Tree from label_config
         """
@@ -351,7 +434,8 @@ class TaxonomyEvalItem(EvalItem):
                             return a
             return None
 
-        temp = parse_config_to_json(label_config)
+        # shared parsed config is only read here, so it isn't copied
+        temp = label_configs_cache.get(label_config, 'json', _parse_config_to_json)
         res = recursive_lookup(temp)
         tree = TaxonomyEvalItem._subtree(res.get('Choice'))
         return tree
@@ -372,9 +456,17 @@ class TaxonomyEvalItem(EvalItem):
         return subtree
 
     @staticmethod
-    def _transform_tree(config, node):
+    def _index(label_config, control_name=None):
+        """
+        Taxonomy paths index, built once per label config and control name
+        """
+        return label_configs_cache.get(label_config, ('taxonomy_index', control_name),
+                                       partial(TaxonomyEvalItem._build_index, control_name=control_name))
+
+    @staticmethod
+    def _build_index(label_config, control_name=None):
         """
-        Transform tree to FULL paths list
+        Map path of every node in Tree to FULL paths of its leaves
         Example:
             Label config:
             <Taxonomy name="taxonomy" toName="text">
@@ -385,45 +477,36 @@ class TaxonomyEvalItem(EvalItem):
               </Choice>
             </Choice>
 
-            Results for value ['A'] -> [['A', 'AA', 'AAA'], ['A', 'AA', 'AAB']]
-            Results for value ['AA'] -> [['AA', 'AAA'], ['AA', 'AAB']]
+            Paths for node ('A',) -> (('A', 'AA', 'AAA'), ('A', 'AA', 'AAB'))
+            Paths for node ('A', 'AA', 'AAA') -> (('A', 'AA', 'AAA'),)
+        Leaf paths tuples are shared by all their ancestors
         """
-        import operator
-        from functools import reduce
+        index = {}
 
-        def paths(self):
-            """
-            Get all paths from Tree
-            """
-            if not self.keys():
-                return []
-            local_paths = []
-            for child in self:
-                child_paths = paths(self[child])
-                if child_paths:
-                    for path in child_paths:
-                        local_paths.append([child] + path)
-                else:
-                    local_paths.append([child])
-            return local_paths
-
-        nodes = []
-        try:
-            items = reduce(operator.getitem, node, config)
-        except KeyError as exc:
-            logger.warning(f'Node {node} was not found in current label config!'
-                           f'Reason: {exc}', exc_info=True)
-            return [node]
-        path_list = paths(items)
-        if path_list:
-            for path in path_list:
-                temp_node = deepcopy(node)
-                temp_node.extend(path)
-                nodes.append(temp_node)
-        else:
-            nodes.append(node)
+        def add(path, subtree):
+            leaves = []
+            for child, child_subtree in subtree.items():
+                leaves.extend(add(path + (child,), child_subtree))
+            index[path] = tuple(leaves) or (path,)
+            return index[path]
 
-        return nodes
+        add((), TaxonomyEvalItem._tree(label_config, control_name))
+        return index
+
+    @staticmethod
+    def _expand(index, taxonomy):
+        """
+        Transform taxonomy nodes to FULL paths list
+        """
+        paths = []
+        for node in taxonomy:
+            node = tuple(node)
+            node_paths = index.get(node)
+            if node_paths is None:
+                logger.warning(f'Node {list(node)} was not found in current label config!')
+                node_paths = (node,)
+            paths.extend(node_paths)
+        return paths
 
     @staticmethod
     def _compare_list(gt, pred):
@@ -446,7 +529,7 @@ class SimpleComparisionEvalItem(EvalItem):
         if region and check_condition:
             logger.debug(f"Returning per region calculation")
             return int(gt[self._shape_key] == pred[self._shape_key]), \
-                   EvalItem.general_iou_by_type(region, gt, pred)
+                   EvalItem.general_iou_by_type(region, gt, pred, self._polygons)
         logger.debug(f"Returning simple calculation")
         if check_condition:
             return int(gt[self._shape_key] == pred[self._shape_key]), 1.0
@@ -528,6 +611,16 @@ def intersection_html_tagging(item_gt,
     return item_gt.intersection(item_pred, label_weights, algorithm=algorithm, qval=qval, per_label=per_label, iou_threshold=iou_threshold)
 
 
+def textareas_symmetric(algorithm='Levenshtein', qval=1, **kwargs):
+    """
+    Check match_textareas doesn't depend on the order of items for the given params
+    """
+    if algorithm is None and qval is None:
+        # texts are compared by equality
+        return True
+    return algorithm in SYMMETRIC_TEXT_ALGORITHMS
+
+
 def match_textareas(item_gt, item_pred, algorithm='Levenshtein', qval=1, **kwargs):
     qval = int(qval or 0) or None
     item_gt = _as_textarea_eval_item(item_gt, **kwargs)
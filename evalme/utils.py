@@ -1,18 +1,35 @@
+import hashlib
 import xmljson
+import copy
 import textdistance
 import random
 import re
 
+import numpy as np
+
+from datetime import datetime
 from itertools import zip_longest
-from collections import Counter
+from collections import Counter, OrderedDict
 from enum import Enum
+from dateutil import parser
 from lxml import etree
 
-from shapely.validation import explain_validity
 from shapely.validation import make_valid
 from shapely.geometry import Polygon, MultiPolygon, LineString
 from shapely.ops import unary_union, polygonize
 
+try:
+    # C implementation of Levenshtein distance
+    from rapidfuzz.distance import Levenshtein as rapidfuzz_levenshtein
+except ImportError:
+    rapidfuzz_levenshtein = None
+
+TEXT_SIMILARITY_CACHE_SIZE = 4096
+# total length of texts kept by TextComparator cache
+TEXT_SIMILARITY_CACHE_LENGTH = 1 << 20
+# bounded scores reject only values below the bound by this margin, so float rounding can't flip hard decisions
+SCORE_BOUND_TOLERANCE = 1e-9
+
 _text_comparators = {}
 
 
@@ -24,30 +41,243 @@ class Result(Enum):
     TN = 4
 
 
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def bounded_levenshtein(s1, s2, max_distance):
+    """
+    Levenshtein distance computed only inside the diagonal band of width 2 * max_distance + 1 (Ukkonen)
+    :return: distance if it doesn't exceed max_distance, otherwise max_distance + 1
+    """
+    if len(s1) > len(s2):
+        s1, s2 = s2, s1
+    exceeded = max_distance + 1
+    if max_distance < 0 or len(s2) - len(s1) > max_distance:
+        # distance is at least the difference of lengths
+        return exceeded
+    # common prefix and suffix don't change the distance
+    start = 0
+    while start < len(s1) and s1[start] == s2[start]:
+        start += 1
+    end1, end2 = len(s1), len(s2)
+    while end1 > start and s1[end1 - 1] == s2[end2 - 1]:
+        end1 -= 1
+        end2 -= 1
+    s1, s2 = s1[start:end1], s2[start:end2]
+    n, m = len(s1), len(s2)
+    if n == 0:
+        return m
+    previous = [j if j <= max_distance else exceeded for j in range(m + 1)]
+    for i in range(1, n + 1):
+        # cells outside of the band are further than max_distance from the diagonal
+        current = [exceeded] * (m + 1)
+        if i <= max_distance:
+            current[0] = i
+        row_min = current[0]
+        c = s1[i - 1]
+        for j in range(max(1, i - max_distance), min(m, i + max_distance) + 1):
+            value = min(previous[j - 1] + (c != s2[j - 1]), previous[j] + 1, current[j - 1] + 1, exceeded)
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            # distances never decrease from row to row
+            return exceeded
+        previous = current
+    return previous[m]
+
+
+class TextComparator:
+    """
+    Normalized similarity of texts by textdistance algorithm with LRU cache of scored pairs
+    bounded by the number of pairs and their total length,
+    Levenshtein distance of strings is computed by rapidfuzz if it's installed
+    """
+
+    def __init__(self, algorithm, qval, max_size=TEXT_SIMILARITY_CACHE_SIZE, max_length=TEXT_SIMILARITY_CACHE_LENGTH):
+        self.algorithm = algorithm
+        self.qval = qval
+        self.max_size = max_size
+        self.max_length = max_length
+        self._length = 0
+        self.hits = 0
+        self.misses = 0
+        self._measure = getattr(textdistance, algorithm)(qval=qval)
+        self._distance = None
+        if rapidfuzz_levenshtein is not None and qval == 1 and type(self._measure) is textdistance.Levenshtein:
+            self._distance = rapidfuzz_levenshtein.distance
+        self._scores = OrderedDict()
+
+    def _similarity(self, x, y):
+        if self._distance is not None and isinstance(x, str) and isinstance(y, str):
+            # distance is an exact integer in both backends, normalized the same way as in textdistance
+            maximum = max(len(x), len(y))
+            if maximum == 0:
+                return 1
+            return 1 - self._distance(x, y) / maximum
+        return self._measure.normalized_similarity(x, y)
+
+    def __call__(self, x, y):
+        key = (x, y)
+        try:
+            score = self._scores.get(key)
+        except TypeError:
+            # unhashable sequences are not cached
+            return self._similarity(x, y)
+        if score is not None:
+            self.hits += 1
+            self._scores.move_to_end(key)
+            return score
+        return self._store(key, self._similarity(x, y))
+
+    def _max_distance(self, maximum, min_similarity):
+        """
+        The largest Levenshtein distance with normalized similarity greater than min_similarity, -1 if there is no such
+        """
+        distance = min(max(int((1 - min_similarity) * maximum), 0), maximum)
+        while distance >= 0 and not 1 - distance / maximum > min_similarity:
+            distance -= 1
+        while distance < maximum and 1 - (distance + 1) / maximum > min_similarity:
+            distance += 1
+        return distance
+
+    def bounded(self, x, y, min_similarity):
+        """
+        Similarity of x and y if it's greater than min_similarity, None otherwise.
+        Levenshtein distance of strings is computed only up to the distance allowed by min_similarity
+        :param min_similarity: similarities not greater than it are not computed exactly
+        :return: score or None
+        """
+        try:
+            score = self._scores.get((x, y))
+        except TypeError:
+            score = None
+        strings = isinstance(x, str) and isinstance(y, str) and len(x) + len(y) > 0
+        levenshtein = self.qval == 1 and type(self._measure) is textdistance.Levenshtein
+        if score is None and strings and levenshtein and min_similarity >= 0:
+            maximum = max(len(x), len(y))
+            # difference of lengths is the lower bound of distance
+            if not 1 - abs(len(x) - len(y)) / maximum > min_similarity:
+                return None
+            max_distance = self._max_distance(maximum, min_similarity)
+            if self._distance is not None:
+                distance = self._distance(x, y, score_cutoff=max_distance)
+            else:
+                distance = bounded_levenshtein(x, y, max_distance)
+            if distance > max_distance:
+                return None
+            return self._store((x, y), 1 - distance / maximum)
+        if score is None:
+            score = self(x, y)
+        return score if score > min_similarity else None
+
+    def _store(self, key, score):
+        self.misses += 1
+        length = len(key[0]) + len(key[1])
+        if self.max_size > 0 and length <= self.max_length:
+            self._scores[key] = score
+            self._length += length
+            while len(self._scores) > self.max_size or self._length > self.max_length:
+                (x, y), _ = self._scores.popitem(last=False)
+                self._length -= len(x) + len(y)
+        return score
+
+    def batch(self, pairs):
+        """
+        Score list of (x, y) pairs, repeated pairs are scored once
+        :param pairs: list of texts pairs
+        :return: list of scores in the order of pairs
+        """
+        scores = {}
+        result = []
+        for x, y in pairs:
+            try:
+                score = scores.get((x, y))
+            except TypeError:
+                result.append(self(x, y))
+                continue
+            if score is None:
+                score = scores[(x, y)] = self(x, y)
+            result.append(score)
+        return result
+
+    def clear(self):
+        self._scores.clear()
+        self._length = 0
+        self.hits = 0
+        self.misses = 0
+
+
 def get_text_comparator(algorithm, qval):
     if algorithm is None and qval is None:
         # the default comparator fallback to simple text/labels equality
         return None
     comparator_key = (algorithm, qval)
     if comparator_key not in _text_comparators:
-        _text_comparators[comparator_key] = getattr(textdistance, algorithm)(qval=qval)
-    return _text_comparators[comparator_key].normalized_similarity
+        _text_comparators[comparator_key] = TextComparator(algorithm, qval)
+    return _text_comparators[comparator_key]
 
 
-def texts_similarity(x, y, f=None):
+def texts_similarity(x, y, f=None, min_score=None):
+    """
+    Mean similarity of texts in x and y
+    :param f: text comparator, texts are compared by equality if not set
+    :param min_score: mean similarity not greater than min_score can be returned as 0,
+    bounded comparison stops as soon as the mean can't exceed it
+    """
     if not f:
         # the default comparator fallback to simple text/labels equality
         return x == y
-    scores = []
-    for xi, yi in zip_longest(x, y):
-        if xi is None or yi is None:
-            scores.append(0)
-        else:
-            scores.append(f(xi, yi))
-    mean_score = sum(scores) / max(len(scores), 1)
+    pairs = list(zip_longest(x, y))
+    # missing values score 0 and don't change the sum
+    scored = [(xi, yi) for xi, yi in pairs if xi is not None and yi is not None]
+    if min_score is not None and isinstance(f, TextComparator):
+        total = 0
+        for k, (xi, yi) in enumerate(scored):
+            # each of the next pairs scores 1 at most
+            score = f.bounded(xi, yi, min_score * len(pairs) - total - (len(scored) - k - 1) - SCORE_BOUND_TOLERANCE)
+            if score is None:
+                return 0
+            total += score
+        return total / max(len(pairs), 1)
+    if isinstance(f, TextComparator):
+        scores = f.batch(scored)
+    else:
+        scores = [f(xi, yi) for xi, yi in scored]
+    mean_score = sum(scores) / max(len(pairs), 1)
     return mean_score
 
 
+def longest_prefix_occurrence(text, pattern):
+    """
+    Length of the longest prefix of pattern occurring in text.
+    Prefixes of an occurring prefix occur too, so the length is found by binary search with O(log n) substring
+    searches instead of growing the prefix by one character
+    """
+    lo, hi = 0, min(len(pattern), len(text))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if pattern[:mid] in text:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def ends_overlap_ratio(text1, text2):
+    """
+    Overlap of text1 end with text2 start w.r.t. both texts.
+    The longest prefix of text2 found in text1 (shorter than text2) has to be at the end of text1, otherwise -1
+    """
+    ind = min(longest_prefix_occurrence(text1, text2), max(len(text2) - 1, 0))
+    if text1.endswith(text2[:ind]):
+        return ind / (len(text1) + len(text2) - ind)
+    return -1
+
+
 def calculate_ap(results):
     """
     Calculation AP for results list
@@ -98,7 +328,61 @@ def calculate_ap(results):
     return s / 11
 
 
-def parse_config_to_json(config_string):
+# LABEL CONFIG methods
+LABEL_CONFIGS_CACHE_SIZE = 256
+
+
+class LabelConfigsCache:
+    """
+    Process-wide LRU cache of objects built from label configs keyed by (config hash, key),
+    cached objects are shared between callers and must not be modified.
+    Configs other than str or bytes are passed to build uncached, so its errors are kept
+    """
+
+    def __init__(self, max_size=LABEL_CONFIGS_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._objects = OrderedDict()
+
+    @staticmethod
+    def config_hash(config_string):
+        if isinstance(config_string, str):
+            config_string = config_string.encode('utf-8')
+        return hashlib.sha1(config_string).hexdigest()
+
+    def get(self, config_string, key, build):
+        """
+        Get object built from label config
+        :param config_string: label config
+        :param key: kind of object built from label config
+        :param build: function building object from config string
+        """
+        if not isinstance(config_string, (str, bytes)):
+            return build(config_string)
+        cache_key = (self.config_hash(config_string), key)
+        if cache_key in self._objects:
+            self.hits += 1
+            self._objects.move_to_end(cache_key)
+            return self._objects[cache_key]
+        self.misses += 1
+        obj = build(config_string)
+        if self.max_size > 0:
+            self._objects[cache_key] = obj
+            if len(self._objects) > self.max_size:
+                self._objects.popitem(last=False)
+        return obj
+
+    def clear(self):
+        self._objects.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+label_configs_cache = LabelConfigsCache()
+
+
+def _parse_config_to_json(config_string):
     parser = etree.XMLParser(recover=False)
     xml = etree.fromstring(config_string, parser)
     if xml is None:
@@ -107,101 +391,307 @@ def parse_config_to_json(config_string):
     return config
 
 
+def parse_config_to_json(config_string):
+    """
+    Label config converted to json by badgerfish convention, parsed once per config
+    :return: copy of the cached json, so callers may modify it
+    """
+    return copy.deepcopy(label_configs_cache.get(config_string, 'json', _parse_config_to_json))
+
+
+# DATETIME methods
+DATETIME_CACHE_SIZE = 65536
+# ISO-8601 dates and times parsed by `datetime.fromisoformat` the same way as by dateutil
+ISO_DATETIME_RE = re.compile(r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?(Z|[+-]\d{2}:\d{2})?')
+
+
+class DatetimeParser:
+    """
+    LRU cache of datetimes parsed from strings, ISO-8601 strings are parsed without dateutil
+    """
+
+    def __init__(self, max_size=DATETIME_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._datetimes = OrderedDict()
+
+    @staticmethod
+    def _parse(value):
+        if ISO_DATETIME_RE.fullmatch(value):
+            try:
+                return datetime.fromisoformat(value)
+            except ValueError:
+                # python < 3.11 supports fewer ISO formats
+                pass
+        return parser.parse(value)
+
+    def parse(self, value):
+        if not isinstance(value, str):
+            return parser.parse(value)
+        dt = self._datetimes.get(value)
+        if dt is not None:
+            self.hits += 1
+            self._datetimes.move_to_end(value)
+            return dt
+        self.misses += 1
+        dt = self._parse(value)
+        if self.max_size > 0:
+            self._datetimes[value] = dt
+            if len(self._datetimes) > self.max_size:
+                self._datetimes.popitem(last=False)
+        return dt
+
+    def clear(self):
+        self._datetimes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+datetime_parser = DatetimeParser()
+
+
+def parse_datetime(value):
+    """
+    `dateutil.parser.parse` through the process-wide parsed datetimes cache
+    """
+    return datetime_parser.parse(value)
+
+
+# SPANS methods
+# spans lengths differ at most SPANS_LENGTH_CLASS_BASE times inside of SpansIndex length class
+SPANS_LENGTH_CLASS_BASE = 16
+
+
+class SpansIndex:
+    """
+    Spans sorted by start to find spans overlapping [start, end] with binary search.
+    Spans are split into length classes by powers of SPANS_LENGTH_CLASS_BASE,
+    so long spans don't widen search window of short ones
+    """
+
+    def __init__(self, indices, starts, ends):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = ends - starts
+        classes = np.floor(np.log(np.maximum(lengths, 1)) / np.log(SPANS_LENGTH_CLASS_BASE)).astype(np.int64)
+        self._classes = []
+        for length_class in np.unique(classes):
+            mask = classes == length_class
+            order = np.argsort(starts[mask], kind='stable')
+            # overlapping span of the class starts not earlier than start - max_length
+            self._classes.append((starts[mask][order], ends[mask][order], indices[mask][order],
+                                  float(lengths[mask].max())))
+
+    def overlapping(self, start, end):
+        """
+        Indices of spans with span.start <= end and span.end >= start in increasing order
+        """
+        found = []
+        for starts, ends, indices, max_length in self._classes:
+            lo = np.searchsorted(starts, start - max_length, side='left')
+            hi = np.searchsorted(starts, end, side='right')
+            found.append(indices[lo:hi][ends[lo:hi] >= start])
+        if len(found) == 1:
+            return np.sort(found[0]).tolist()
+        return np.sort(np.concatenate(found)).tolist() if found else []
+
+    def __len__(self):
+        return sum(len(indices) for _, _, indices, _ in self._classes)
+
+
 # POLYGON methods
+def bounds_overlap(a, b):
+    """
+    Check if (minx, miny, maxx, maxy) bounds overlap, shapes with not overlapping bounds have no intersection
+    """
+    return not (a[2] < b[0] or b[2] < a[0] or a[3] < b[1] or b[3] < a[1])
+
+
 def _area_close(p1, p2, distance=0.1):
     return abs(p1.area / max(p2.area, 1e-8) - 1) < distance
 
 
-def _try_build_poly(points):
-    poly = Polygon(points)
-    # Everything is OK, points are valid polygon
-    if poly.is_valid:
-        return poly
-    # try making valid polygon
-    poly = make_valid(poly)
-    if poly.is_valid:
-        return poly
+# polygon repair stages in order of application, see `_try_build_poly`
+POLYGON_REPAIR_STAGES = ('make_valid', 'buffer', 'polygonize', 'convex_hull', 'dilation', 'erosion', 'remove_points')
+# buffer distances for dilation, negated for erosion
+POLYGON_BUFFER_DISTANCES = tuple(0.01 * 2 ** i for i in range(11))
+# rounds of self-intersections detection in `_remove_points`
+POLYGON_REMOVE_POINTS_ROUNDS = 3
+
+
+def _repair_make_valid(poly, points):
+    return make_valid(poly)
+
 
+def _repair_buffer(poly, points):
     # Polygon contains small bowties, we can fix them:
     # (https://stackoverflow.com/questions/13062334/polygon-intersection-error-in-shapely-shapely-geos-topologicalerror-the-opera)
     fixed_poly = poly.buffer(0)
     if not fixed_poly.geom_type == 'MultiPolygon' and _area_close(fixed_poly, poly):
         return fixed_poly
 
+
+def _repair_polygonize(poly, points):
     # Trying to build multiple polygons from self intersected polygon
-    line_non_simple = LineString(points)
-    mls = unary_union(line_non_simple)
+    mls = unary_union(LineString(points))
     polygons = list(polygonize(mls))
     multi_poly = MultiPolygon(polygons)
     if len(polygons) and multi_poly.is_valid:
         return multi_poly
 
-    # Trying to draw convex hull
+
+def _repair_convex_hull(poly, points):
     convex_hull = poly.convex_hull
     if _area_close(convex_hull, poly):
         return convex_hull
-    # trying to fix polygon with dilation
-    distance = 0.01
-    while distance < 11:
-        fixed_poly = poly.buffer(distance)
-        flag = _area_close(fixed_poly, poly)
-        if fixed_poly.is_valid and flag:
-            return fixed_poly
-        else:
-            distance = distance * 2
-
-    # trying to fix polygon with errosion
-    distance = -0.01
-    while distance > -11:
-        fixed_poly = poly.buffer(distance)
-        flag = _area_close(fixed_poly, poly)
-        if fixed_poly.is_valid and flag:
+
+
+def _repair_buffer_distances(poly, sign):
+    for distance in POLYGON_BUFFER_DISTANCES:
+        fixed_poly = poly.buffer(sign * distance)
+        if fixed_poly.is_valid and _area_close(fixed_poly, poly):
             return fixed_poly
-        else:
-            distance = distance * 2
+        # area changes monotonically with distance, further buffers are not closer
+        if fixed_poly.is_valid and sign * (fixed_poly.area - poly.area) > 0 and not _area_close(fixed_poly, poly):
+            return None
+
 
+def _repair_dilation(poly, points):
+    return _repair_buffer_distances(poly, 1)
+
+
+def _repair_erosion(poly, points):
+    return _repair_buffer_distances(poly, -1)
+
+
+def _repair_remove_points(poly, points):
     # trying to delete points near loop
     poly1 = _remove_points(poly, points)
     if poly1.is_valid and _area_close(poly1, poly):
         return poly1
 
+
+POLYGON_REPAIRS = {
+    'make_valid': _repair_make_valid,
+    'buffer': _repair_buffer,
+    'polygonize': _repair_polygonize,
+    'convex_hull': _repair_convex_hull,
+    'dilation': _repair_dilation,
+    'erosion': _repair_erosion,
+    'remove_points': _repair_remove_points,
+}
+
+
+def _try_build_poly(points, stages=None, stats=None):
+    """
+    Build valid polygon from points, invalid polygons are repaired by stages until one of them succeeds
+    :param points: list of [x, y]
+    :param stages: names of repair stages from POLYGON_REPAIRS, POLYGON_REPAIR_STAGES if not set
+    :param stats: Counter of polygons built by each repair stage, 'valid' and 'failed' for polygons built
+    without or failed repair, not counted if not set
+    :return: shapely geometry
+    """
+    if stats is None:
+        stats = Counter()
+    poly = Polygon(points)
+    # Everything is OK, points are valid polygon
+    if poly.is_valid:
+        stats['valid'] += 1
+        return poly
+    for stage in stages or POLYGON_REPAIR_STAGES:
+        fixed_poly = POLYGON_REPAIRS[stage](poly, points)
+        if stage == 'make_valid' and not fixed_poly.is_valid:
+            # next stages repair the output of make_valid
+            poly = fixed_poly
+            continue
+        if fixed_poly is not None:
+            stats[stage] += 1
+            return fixed_poly
+
     # We are failing to build polygon, this shall be reported via error log
+    stats['failed'] += 1
     raise ValueError(f'Fail to build polygon from {points}')
 
 
+def _self_intersections(points):
+    """
+    Self-intersection points of polygon boundary found in a single noding pass
+    """
+    points = [tuple(point) for point in points]
+    noded = unary_union(LineString(points + points[:1]))
+    # noding splits boundary at intersections, so they are ends of more than 2 lines
+    ends = Counter()
+    for line in getattr(noded, 'geoms', [noded]):
+        ends[line.coords[0]] += 1
+        ends[line.coords[-1]] += 1
+    return [point for point, count in ends.items() if count > 2]
+
+
 def _remove_points(poly, points):
     """
-    Trying to remove some points to make polygon valid
+    Trying to remove some points to make polygon valid. Each round removes the points nearest to all
+    self-intersections found at once, at most POLYGON_REMOVE_POINTS_ROUNDS rounds are made
     """
+    points = list(points)
     removed_points = []
-    invalidity = explain_validity(poly)
-    for i in range(len(points) - 4):
-        match = re.findall("\d+\.\d+", invalidity)
-        min_distance = poly.area
-        min_point = None
-        if match:
-            intersect_point = (float(match[0]), float(match[1]))
-            for point in points:
-                distance = abs(point[0] - intersect_point[0]) + abs(point[1] - intersect_point[1])
-                if distance < min_distance:
-                    min_distance = distance
-                    min_point = point
+    poly1 = poly
+    for _ in range(POLYGON_REMOVE_POINTS_ROUNDS):
+        intersections = _self_intersections(points)
+        # remove points nearest to each self-intersection
+        for x, y in intersections:
+            if len(points) <= 4:
+                break
+            min_point = min(points, key=lambda point: abs(point[0] - x) + abs(point[1] - y))
             removed_points.append(min_point)
             points.remove(min_point)
-            poly1 = Polygon(points)
+        if not intersections or len(points) <= 4:
+            break
+        poly1 = Polygon(points)
         if poly1.is_valid:
             break
-        invalidity = explain_validity(poly1)
-    if _area_close(poly, poly1):
+    if poly1 is not poly and _area_close(poly, poly1):
         return poly1
     random.shuffle(removed_points)
     for item in removed_points:
         points.append(item)
-        poly2 = Polygon(points)
-        poly2 = poly2.buffer(0)
-        if poly2.is_valid:
-            continue
-        else:
+        poly1 = Polygon(points).buffer(0)
+        if not poly1.is_valid:
             points.remove(item)
-    return poly2
+    return poly1
+
+
+POLYGONS_CACHE_SIZE = 4096
+
+
+class PolygonsCache:
+    """
+    LRU cache of polygons keyed by points, each polygon is built and validated once
+    """
+
+    def __init__(self, build=_try_build_poly, max_size=POLYGONS_CACHE_SIZE):
+        self.build = build
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._polygons = OrderedDict()
+
+    def get(self, points):
+        key = tuple(map(tuple, points))
+        poly = self._polygons.get(key)
+        if poly is not None:
+            self.hits += 1
+            self._polygons.move_to_end(key)
+            return poly
+        self.misses += 1
+        # build from copy, polygon repair can remove points
+        poly = self.build(list(points))
+        if self.max_size > 0:
+            self._polygons[key] = poly
+            if len(self._polygons) > self.max_size:
+                self._polygons.popitem(last=False)
+        return poly
 
+    def __len__(self):
+        return len(self._polygons)